@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Almacenamiento de imágenes intercambiable.
+
+La aplicación guarda y elimina imágenes a través de un objeto de almacenamiento
+con la misma interfaz para todos los backends:
+
+    guardar(datos, carpeta, nombre, extension) -> URL pública
+    eliminar(url) -> True si se eliminó
+    eliminar_varias(urls) -> {url: (eliminada, error)} en lotes
+    es_propia(url) -> True si la URL pertenece a este almacenamiento
+    identificador(url) -> clave del archivo dentro del almacenamiento
+    listar(carpeta) -> archivos guardados: {'identificador', 'url', 'fecha'}
+    ruta_local(url) -> ruta en disco del archivo, o None si no es local
+    variante(url, ancho) -> URL de la imagen reducida a `ancho` píxeles (o None)
+
+- AlmacenamientoCloudinary: sube a Cloudinary (CDN).
+- AlmacenamientoLocal: escribe en un directorio del servidor. Los nombres de
+  archivo incluyen un hash del contenido, así que la aplicación puede servirlos
+  con caché de larga duración (un archivo nunca cambia sin cambiar de URL).
+  Las variantes por ancho (`nombre.hash.w480.webp`) las genera la aplicación la
+  primera vez que se piden y se eliminan junto con la imagen original.
+"""
+
+import glob
+import hashlib
+import os
+import re
+import tempfile
+from datetime import datetime
+
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+from werkzeug.security import safe_join
+
+# Sufijo de las variantes locales: `.w<ancho>` antes de la extensión
+SUFIJO_VARIANTE = re.compile(r'\.w(\d+)(\.[A-Za-z0-9]+)$')
+
+
+class AlmacenamientoCloudinary:
+    """Imágenes en Cloudinary; el public_id es `carpeta/nombre`"""
+
+    nombre = 'cloudinary'
+    # Máximo de public_ids por llamada a delete_resources de la Admin API
+    LOTE_ELIMINACION = 100
+
+    def __init__(self, cloud_name, api_key, api_secret):
+        self.cloud_name = cloud_name
+        self.api_key = api_key
+        self.api_secret = api_secret
+
+    def configurado(self):
+        return bool(self.cloud_name and self.api_key and self.api_secret)
+
+    def guardar(self, datos, carpeta, nombre, extension):
+        resultado = cloudinary.uploader.upload(
+            datos,
+            filename=f'{nombre}.{extension}',
+            public_id=f'{carpeta}/{nombre}',
+            folder=carpeta,
+            resource_type='image'
+        )
+        return resultado['secure_url']
+
+    def es_propia(self, url):
+        return bool(url) and 'cloudinary.com' in url
+
+    @staticmethod
+    def public_id(url):
+        """Extrae el public_id de una URL de Cloudinary (None si no tiene el formato esperado).
+
+        Formato: https://res.cloudinary.com/cloud_name/image/upload/v1234567890/carpeta/archivo.jpg
+        Los puntos del nombre se conservan (p. ej. `Vitamina_C_2.5_kg`); solo se quita
+        la extensión.
+        """
+        partes = url.split('?')[0].split('/')
+        if 'upload' not in partes:
+            return None
+        resto = partes[partes.index('upload') + 1:]
+        if resto and re.fullmatch(r'v\d+', resto[0]):
+            resto = resto[1:]  # Versión
+        if not resto:
+            return None
+        return '/'.join(resto).rsplit('.', 1)[0]
+
+    def eliminar(self, url):
+        if not self.configurado() or not self.es_propia(url):
+            return False
+        public_id = self.public_id(url)
+        if not public_id:
+            return False
+        resultado = cloudinary.uploader.destroy(public_id)
+        if resultado.get('result') != 'ok':
+            print(f"⚠️ No se pudo eliminar imagen de Cloudinary: {resultado}")
+            return False
+        print(f"✅ Imagen eliminada de Cloudinary: {public_id}")
+        return True
+
+    def identificador(self, url):
+        return self.public_id(url) if self.es_propia(url) else None
+
+    def eliminar_varias(self, urls):
+        """Elimina en lotes con la Admin API (una llamada por cada 100 imágenes)"""
+        resultados = {}
+        ids = {}
+        for url in urls:
+            public_id = self.identificador(url)
+            if public_id:
+                ids[url] = public_id
+            else:
+                resultados[url] = (True, None)  # Nada que eliminar en Cloudinary
+        unicos = sorted(set(ids.values()))
+        estados = {}
+        for inicio in range(0, len(unicos), self.LOTE_ELIMINACION):
+            respuesta = cloudinary.api.delete_resources(unicos[inicio:inicio + self.LOTE_ELIMINACION])
+            estados.update(respuesta.get('deleted', {}))
+        for url, public_id in ids.items():
+            estado = estados.get(public_id)
+            if estado == 'deleted':
+                resultados[url] = (True, None)
+            else:
+                # 'not_found' suele indicar un public_id mal derivado de la URL: se
+                # registra como error para no dar por eliminada una imagen que sigue ahí
+                print(f"⚠️ Cloudinary no eliminó {public_id}: {estado}")
+                resultados[url] = (False, f'Cloudinary respondió: {estado} ({public_id})')
+        return resultados
+
+    def listar(self, carpeta):
+        """Recorre las imágenes subidas bajo `carpeta/`, paginando de 500 en 500"""
+        cursor = None
+        while True:
+            opciones = {'type': 'upload', 'prefix': f'{carpeta}/', 'max_results': 500}
+            if cursor:
+                opciones['next_cursor'] = cursor
+            respuesta = cloudinary.api.resources(**opciones)
+            for recurso in respuesta.get('resources', []):
+                yield {
+                    'identificador': recurso['public_id'],
+                    'url': recurso['secure_url'],
+                    'fecha': datetime.strptime(recurso['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+                }
+            cursor = respuesta.get('next_cursor')
+            if not cursor:
+                break
+
+    def variante(self, url, ancho):
+        """Transformación en la URL: Cloudinary genera y guarda en su CDN la versión reducida"""
+        if not self.es_propia(url) or '/upload/' not in url:
+            return None
+        inicio, resto = url.split('/upload/', 1)
+        return f'{inicio}/upload/w_{ancho},c_limit,q_auto,f_auto/{resto}'
+
+    def ruta_local(self, url):
+        return None
+
+
+class AlmacenamientoLocal:
+    """Imágenes en disco, servidas por la aplicación bajo `url_base`"""
+
+    nombre = 'local'
+
+    def __init__(self, directorio, url_base='/medios'):
+        self.directorio = directorio
+        self.url_base = url_base.rstrip('/')
+
+    def configurado(self):
+        return True
+
+    def guardar(self, datos, carpeta, nombre, extension):
+        huella = hashlib.sha256(datos).hexdigest()[:12]
+        relativa = f'{carpeta}/{nombre}.{huella}.{extension}'
+        destino = safe_join(self.directorio, relativa)
+        if destino is None:
+            raise ValueError(f'Ruta de imagen no válida: {relativa}')
+        self.escribir(destino, datos)
+        return f'{self.url_base}/{relativa}'
+
+    @staticmethod
+    def escribir(destino, datos):
+        """Escribe en un temporal y renombra: nunca se sirve un archivo a medio escribir"""
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(destino), suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as salida:
+                salida.write(datos)
+            os.replace(temporal, destino)
+        except BaseException:
+            os.remove(temporal)
+            raise
+
+    def es_propia(self, url):
+        return bool(url) and url.startswith(self.url_base + '/')
+
+    def identificador(self, url):
+        return url[len(self.url_base) + 1:].split('?')[0] if self.es_propia(url) else None
+
+    def ruta_local(self, url):
+        identificador = self.identificador(url)
+        return safe_join(self.directorio, identificador) if identificador else None
+
+    def variante(self, url, ancho):
+        if not self.es_propia(url):
+            return None
+        base, extension = os.path.splitext(url.split('?')[0])
+        return f'{base}.w{ancho}{extension}'
+
+    @staticmethod
+    def original_de_variante(identificador):
+        """Devuelve (identificador del original, ancho) de una variante, o (None, None)"""
+        coincidencia = SUFIJO_VARIANTE.search(identificador)
+        if not coincidencia:
+            return None, None
+        return identificador[:coincidencia.start()] + coincidencia.group(2), int(coincidencia.group(1))
+
+    @staticmethod
+    def rutas_con_variantes(ruta):
+        """La ruta del original más las de sus variantes ya generadas"""
+        base, extension = os.path.splitext(ruta)
+        variantes = [
+            candidata for candidata in glob.glob(glob.escape(base) + '.w*' + glob.escape(extension))
+            if SUFIJO_VARIANTE.search(candidata)
+        ]
+        return [ruta] + variantes
+
+    def listar(self, carpeta):
+        raiz = safe_join(self.directorio, carpeta)
+        if not raiz or not os.path.isdir(raiz):
+            return
+        for directorio, _, archivos in os.walk(raiz):
+            for archivo in archivos:
+                if archivo.endswith('.tmp'):
+                    continue
+                ruta = os.path.join(directorio, archivo)
+                identificador = os.path.relpath(ruta, self.directorio).replace(os.sep, '/')
+                # Las variantes se eliminan con su original; solo se listan las que
+                # quedaron sin él (generadas mientras se eliminaba el original)
+                original, _ = self.original_de_variante(identificador)
+                if original and os.path.isfile(safe_join(self.directorio, original)):
+                    continue
+                yield {
+                    'identificador': identificador,
+                    'url': f'{self.url_base}/{identificador}',
+                    'fecha': datetime.utcfromtimestamp(os.path.getmtime(ruta))
+                }
+
+    def eliminar(self, url):
+        ruta = self.ruta_local(url)
+        if not ruta or not os.path.isfile(ruta):
+            return False
+        for archivo in self.rutas_con_variantes(ruta):
+            os.remove(archivo)
+        print(f"✅ Imagen eliminada del disco: {ruta}")
+        return True
+
+    def eliminar_varias(self, urls):
+        resultados = {}
+        for url in urls:
+            try:
+                ruta = self.ruta_local(url)
+                if ruta and os.path.isfile(ruta):
+                    for archivo in self.rutas_con_variantes(ruta):
+                        os.remove(archivo)
+                resultados[url] = (True, None)
+            except OSError as e:
+                resultados[url] = (False, str(e))
+        return resultados
@@ -1,9 +1,17 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, abort, Response, stream_with_context, send_file, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import case, delete, event, func, insert, inspect, tuple_, update
+from sqlalchemy.orm import joinedload, selectinload
 from flask_cors import CORS
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from datetime import datetime, timedelta
+from migraciones import aplicar_migraciones
+from almacenamiento import AlmacenamientoCloudinary, AlmacenamientoLocal
+from imagenes import EXTENSIONES, ImagenInvalida, TAMANO_BANNER, TAMANO_LOGO, TAMANO_PRODUCTO, procesar_imagen
+from markupsafe import Markup, escape
 import os
 from dotenv import load_dotenv
 import requests
@@ -13,8 +21,22 @@ import cloudinary.uploader
 import cloudinary.api
 from werkzeug.utils import secure_filename
 import uuid
+import base64
+import click
+import hashlib
+import bisect
+import heapq
+import itertools
+import re
+import unicodedata
 import csv
 import io
+import tempfile
+import threading
+import queue
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Cargar variables de entorno
 load_dotenv()
@@ -53,9 +75,126 @@ else:
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Migraciones al importar la aplicación: solo por defecto en SQLite (desarrollo).
+# En producción las aplica init_db_koyeb.py durante el despliegue, para que los
+# workers no construyan índices CONCURRENTLY al arrancar.
+MIGRAR_AL_INICIAR = os.environ.get(
+    'MIGRAR_AL_INICIAR', str(app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'))
+).lower() == 'true'
+
 db = SQLAlchemy(app)
 CORS(app)
 
+# Caché en memoria con expiración (TTL) y desalojo LRU
+class CacheTTL:
+    """Caché en memoria por proceso con expiración por tiempo y límite de entradas"""
+    
+    def __init__(self, ttl=60, max_entradas=256):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def obtener(self, clave):
+        """Devuelve (encontrado, valor) para una clave vigente"""
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return False, None
+            valor, expira = entrada
+            if expira < time.monotonic():
+                del self._datos[clave]
+                return False, None
+            self._datos.move_to_end(clave)
+            return True, valor
+    
+    def guardar(self, clave, valor):
+        """Guarda un valor y desaloja las entradas menos usadas si se excede el límite"""
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+    
+    def invalidar(self, claves=None):
+        """Elimina las claves indicadas o todo el contenido si no se indica ninguna"""
+        with self._lock:
+            if claves is None:
+                self._datos.clear()
+            else:
+                for clave in claves:
+                    self._datos.pop(clave, None)
+
+# Los valores de configuración cambian muy poco; el TTL acota el tiempo que otros
+# workers de gunicorn pueden servir un valor desactualizado tras un cambio
+CONFIG_CACHE_TTL = int(os.environ.get('CONFIG_CACHE_TTL', 60))
+cache_configuracion = CacheTTL(ttl=CONFIG_CACHE_TTL)
+
+class VersionCatalogo:
+    """Contador que cambia con cada commit que modifica lo que muestra la tienda"""
+    
+    def __init__(self):
+        self._valor = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def valor(self):
+        return self._valor
+    
+    def incrementar(self):
+        with self._lock:
+            self._valor += 1
+            return self._valor
+
+# Páginas renderizadas por versión del catálogo; el TTL cubre los cambios hechos
+# desde otro proceso, que no incrementan la versión de este
+PAGINA_CACHE_TTL = int(os.environ.get('PAGINA_CACHE_TTL', 300))
+version_catalogo = VersionCatalogo()
+cache_paginas = CacheTTL(ttl=PAGINA_CACHE_TTL, max_entradas=16)
+
+# Publicación/suscripción en memoria para empujar eventos a clientes SSE
+class CanalEventos:
+    """Canal de eventos por proceso: cada suscriptor recibe los mensajes en su propia cola"""
+    
+    def __init__(self, max_pendientes=100, max_suscriptores=None):
+        self.max_pendientes = max_pendientes
+        self.max_suscriptores = max_suscriptores
+        self._suscriptores = set()
+        self._lock = threading.Lock()
+    
+    def suscribir(self):
+        """Devuelve la cola del nuevo suscriptor, o None si ya se alcanzó max_suscriptores"""
+        cola = queue.Queue(maxsize=self.max_pendientes)
+        with self._lock:
+            if self.max_suscriptores is not None and len(self._suscriptores) >= self.max_suscriptores:
+                return None
+            self._suscriptores.add(cola)
+        return cola
+    
+    def desuscribir(self, cola):
+        with self._lock:
+            self._suscriptores.discard(cola)
+    
+    def tiene_suscriptores(self):
+        with self._lock:
+            return bool(self._suscriptores)
+    
+    def publicar(self, mensaje):
+        """Entrega el mensaje a todos los suscriptores; los que no consumen pierden mensajes"""
+        with self._lock:
+            suscriptores = list(self._suscriptores)
+        for cola in suscriptores:
+            try:
+                cola.put_nowait(mensaje)
+            except queue.Full:
+                pass
+
+# Cada stream SSE abierto ocupa un hilo del worker (gunicorn gthread --threads 8):
+# se limitan los streams simultáneos para dejar hilos libres a las demás peticiones
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 4))
+
+canal_pedidos = CanalEventos(max_suscriptores=SSE_MAX_STREAMS)
+
 # Configurar Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -76,7 +215,29 @@ class Categoria(db.Model):
     # Relación con productos
     productos = db.relationship('Producto', backref='categoria', lazy=True)
     
-    def to_dict(self):
+    @staticmethod
+    def with_counts(*criterios, limite=None, desplazamiento=0):
+        """Obtiene categorías junto con su cantidad de productos activos e inactivos.
+        
+        Devuelve una lista de tuplas (categoria, productos_activos, productos_inactivos)
+        calculada con un único GROUP BY, sin cargar los productos en memoria.
+        `limite` y `desplazamiento` permiten paginar el resultado.
+        """
+        productos_activos = func.coalesce(func.sum(case((Producto.activo == True, 1), else_=0)), 0)
+        total_productos = func.count(Producto.id)
+        filas = db.session.query(Categoria, productos_activos, total_productos) \
+            .outerjoin(Producto, Producto.categoria_id == Categoria.id) \
+            .filter(*criterios) \
+            .group_by(Categoria.id) \
+            .order_by(Categoria.id) \
+            .limit(limite) \
+            .offset(desplazamiento) \
+            .all()
+        return [(categoria, activos, total - activos) for categoria, activos, total in filas]
+    
+    def to_dict(self, total_productos=None):
+        if total_productos is None:
+            total_productos = Producto.query.filter_by(categoria_id=self.id).count()
         return {
             'id': self.id,
             'nombre': self.nombre,
@@ -85,20 +246,25 @@ class Categoria(db.Model):
             'color': self.color,
             'activa': self.activa,
             'fecha_creacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
-            'total_productos': len(self.productos) if self.productos else 0
+            'total_productos': total_productos
         }
 
 class Producto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    nombre = db.Column(db.String(100), nullable=False)
+    nombre = db.Column(db.String(100), nullable=False, index=True)
     descripcion = db.Column(db.Text)
     precio = db.Column(db.Float, nullable=False)
     imagen = db.Column(db.String(200))
     stock = db.Column(db.Integer, default=0)
     activo = db.Column(db.Boolean, default=True)
-    categoria_id = db.Column(db.Integer, db.ForeignKey('categoria.id'), nullable=True)
+    categoria_id = db.Column(db.Integer, db.ForeignKey('categoria.id'), nullable=True, index=True)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Catálogo de productos activos paginado por id
+    __table_args__ = (
+        db.Index('ix_producto_activo_id', 'activo', 'id'),
+    )
+    
     def to_dict(self):
         """Convierte el objeto Producto a diccionario para JSON"""
         return {
@@ -125,9 +291,29 @@ class Pedido(db.Model):
     fecha_pedido = db.Column(db.DateTime, default=datetime.now)
     items = db.relationship('PedidoItem', backref='pedido', lazy=True)
     
-    def to_dict(self):
+    # Índices para listar por fecha (paginación por cursor) con o sin filtros
+    __table_args__ = (
+        db.Index('ix_pedido_fecha_id', 'fecha_pedido', 'id'),
+        db.Index('ix_pedido_estado_fecha_id', 'estado', 'fecha_pedido', 'id'),
+        db.Index('ix_pedido_telefono_fecha_id', 'cliente_telefono', 'fecha_pedido', 'id'),
+    )
+    
+    @staticmethod
+    def opciones_carga():
+        """Opciones de carga para serializar pedidos con sus items, productos y categorías.
+        
+        Con estas opciones to_dict() usa un número fijo de consultas (pedidos + items
+        con su producto y categoría) sin importar cuántos items tenga cada pedido.
+        """
+        return (
+            selectinload(Pedido.items)
+            .joinedload(PedidoItem.producto)
+            .joinedload(Producto.categoria),
+        )
+    
+    def to_dict(self, incluir_items=True):
         """Convierte el objeto Pedido a diccionario para JSON"""
-        return {
+        datos = {
             'id': self.id,
             'cliente_nombre': self.cliente_nombre,
             'cliente_telefono': self.cliente_telefono,
@@ -135,14 +321,16 @@ class Pedido(db.Model):
             'cliente_comentarios': self.cliente_comentarios,
             'total': self.total,
             'estado': self.estado,
-            'fecha_pedido': self.fecha_pedido.isoformat() if self.fecha_pedido else None,
-            'items': [item.to_dict() for item in self.items]
+            'fecha_pedido': self.fecha_pedido.isoformat() if self.fecha_pedido else None
         }
+        if incluir_items:
+            datos['items'] = [item.to_dict() for item in self.items]
+        return datos
 
 class PedidoItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido.id'), nullable=False)
-    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False)
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido.id'), nullable=False, index=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False, index=True)
     cantidad = db.Column(db.Integer, nullable=False)
     precio_unitario = db.Column(db.Float, nullable=False)
     producto = db.relationship('Producto', backref='pedido_items')
@@ -158,6 +346,80 @@ class PedidoItem(db.Model):
             'producto': self.producto.to_dict() if self.producto else None
         }
 
+class ContadorPedido(db.Model):
+    """Cantidad de pedidos por estado, mantenida en la misma transacción que los pedidos"""
+    __tablename__ = 'contador_pedido'
+    
+    estado = db.Column(db.String(20), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    
+    @staticmethod
+    def obtener():
+        """Devuelve un diccionario estado -> cantidad de pedidos (una fila por estado)"""
+        return dict(db.session.query(ContadorPedido.estado, ContadorPedido.total).all())
+    
+    @staticmethod
+    def ajustar(sesion, deltas):
+        """Suma los deltas (estado -> cambio) a los contadores dentro de la transacción de `sesion`"""
+        deltas = {estado: delta for estado, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        dialecto = sesion.get_bind().dialect.name
+        if dialecto in ('sqlite', 'postgresql'):
+            insertar = sqlite_insert if dialecto == 'sqlite' else postgresql_insert
+            stmt = insertar(ContadorPedido).values([
+                {'estado': estado, 'total': delta} for estado, delta in deltas.items()
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['estado'],
+                set_={'total': ContadorPedido.total + stmt.excluded.total}
+            )
+            sesion.execute(stmt)
+        else:
+            for estado, delta in deltas.items():
+                actualizadas = sesion.execute(
+                    update(ContadorPedido)
+                    .where(ContadorPedido.estado == estado)
+                    .values(total=ContadorPedido.total + delta)
+                ).rowcount
+                if not actualizadas:
+                    sesion.execute(insert(ContadorPedido).values(estado=estado, total=delta))
+    
+    @staticmethod
+    def reconciliar():
+        """Reconstruye los contadores desde la tabla de pedidos y devuelve los nuevos valores"""
+        if db.engine.dialect.name == 'postgresql':
+            # Bloquear escrituras de pedidos mientras se cuentan para no perder cambios
+            db.session.execute(db.text('LOCK TABLE pedido IN SHARE MODE'))
+        estado = func.coalesce(Pedido.estado, 'pendiente')
+        conteos = dict(db.session.query(estado, func.count(Pedido.id)).group_by(estado).all())
+        db.session.query(ContadorPedido).delete()
+        db.session.add_all([ContadorPedido(estado=e, total=t) for e, t in conteos.items()])
+        db.session.commit()
+        return conteos
+
+@event.listens_for(db.session, 'before_flush')
+def actualizar_contadores_pedidos(sesion, contexto, instancias):
+    """Mantiene ContadorPedido al crear, cambiar de estado o eliminar pedidos"""
+    deltas = {}
+    for objeto in sesion.new:
+        if isinstance(objeto, Pedido):
+            estado = objeto.estado or 'pendiente'
+            deltas[estado] = deltas.get(estado, 0) + 1
+    for objeto in sesion.dirty:
+        if isinstance(objeto, Pedido):
+            historial = inspect(objeto).attrs.estado.history
+            if historial.has_changes() and historial.deleted:
+                anterior = historial.deleted[0] or 'pendiente'
+                nuevo = objeto.estado or 'pendiente'
+                deltas[anterior] = deltas.get(anterior, 0) - 1
+                deltas[nuevo] = deltas.get(nuevo, 0) + 1
+    for objeto in sesion.deleted:
+        if isinstance(objeto, Pedido):
+            estado = objeto.estado or 'pendiente'
+            deltas[estado] = deltas.get(estado, 0) - 1
+    ContadorPedido.ajustar(sesion, deltas)
+
 class Usuario(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -194,8 +456,36 @@ class Configuracion(db.Model):
     @staticmethod
     def get_valor(clave, valor_default=''):
         """Obtiene el valor de una configuración"""
-        config = Configuracion.query.filter_by(clave=clave).first()
-        return config.valor if config else valor_default
+        return Configuracion.get_many({clave: valor_default})[clave]
+    
+    @staticmethod
+    def get_many(valores_default):
+        """Obtiene varias configuraciones a la vez (diccionario clave -> valor por defecto).
+        
+        Las claves que no están en caché se cargan con una sola consulta; las claves
+        inexistentes también se guardan en caché para no repetir la búsqueda.
+        """
+        valores = {}
+        faltantes = []
+        for clave in valores_default:
+            encontrado, valor = cache_configuracion.obtener(clave)
+            if encontrado:
+                valores[clave] = valor
+            else:
+                faltantes.append(clave)
+        
+        if faltantes:
+            filas = Configuracion.query.filter(Configuracion.clave.in_(faltantes)).all()
+            encontrados = {config.clave: config.valor for config in filas}
+            for clave in faltantes:
+                valor = encontrados.get(clave)
+                cache_configuracion.guardar(clave, valor)
+                valores[clave] = valor
+        
+        return {
+            clave: valores[clave] if valores[clave] is not None else valor_default
+            for clave, valor_default in valores_default.items()
+        }
     
     @staticmethod
     def set_valor(clave, valor, descripcion=''):
@@ -209,7 +499,60 @@ class Configuracion(db.Model):
             config = Configuracion(clave=clave, valor=valor, descripcion=descripcion)
             db.session.add(config)
         db.session.commit()
+        cache_configuracion.invalidar([clave])
         return config
+    
+    @staticmethod
+    def set_many(valores, descripciones=None):
+        """Establece varias configuraciones en una sola transacción (upsert masivo).
+        
+        `valores` es un diccionario clave -> valor y `descripciones` uno opcional
+        clave -> descripción. En SQLite y PostgreSQL se usa una única sentencia
+        INSERT ... ON CONFLICT DO UPDATE.
+        """
+        if not valores:
+            return 0
+        
+        descripciones = descripciones or {}
+        ahora = datetime.utcnow()
+        filas = [{
+            'clave': clave,
+            'valor': valor,
+            'descripcion': descripciones.get(clave, ''),
+            'fecha_actualizacion': ahora
+        } for clave, valor in valores.items()]
+        
+        dialecto = db.engine.dialect.name
+        if dialecto in ('sqlite', 'postgresql'):
+            insertar = sqlite_insert if dialecto == 'sqlite' else postgresql_insert
+            stmt = insertar(Configuracion).values(filas)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['clave'],
+                set_={
+                    'valor': stmt.excluded.valor,
+                    'descripcion': stmt.excluded.descripcion,
+                    'fecha_actualizacion': stmt.excluded.fecha_actualizacion
+                }
+            )
+            db.session.execute(stmt)
+        else:
+            # Otros motores: una consulta para las existentes y un solo commit
+            existentes = {
+                config.clave: config
+                for config in Configuracion.query.filter(Configuracion.clave.in_(list(valores))).all()
+            }
+            for fila in filas:
+                config = existentes.get(fila['clave'])
+                if config:
+                    config.valor = fila['valor']
+                    config.descripcion = fila['descripcion']
+                    config.fecha_actualizacion = ahora
+                else:
+                    db.session.add(Configuracion(**fila))
+        
+        db.session.commit()
+        cache_configuracion.invalidar(list(valores))
+        return len(filas)
 
 class Banner(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -220,6 +563,10 @@ class Banner(db.Model):
     orden = db.Column(db.Integer, default=0)  # Para ordenar los banners
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_banner_activo_orden', 'activo', 'orden'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -231,6 +578,222 @@ class Banner(db.Model):
             'fecha_creacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None
         }
 
+# Modelos cuyo contenido se muestra en la tienda
+MODELOS_CATALOGO = (Producto, Categoria, Banner, Configuracion)
+
+@event.listens_for(db.session, 'before_flush')
+def marcar_cambios_catalogo(sesion, contexto, instancias):
+    """Marca la transacción si crea, modifica o elimina objetos del catálogo"""
+    for objeto in itertools.chain(sesion.new, sesion.dirty, sesion.deleted):
+        if isinstance(objeto, MODELOS_CATALOGO):
+            sesion.info['catalogo_modificado'] = True
+            return
+
+@event.listens_for(db.session, 'do_orm_execute')
+def marcar_cambios_catalogo_masivos(estado):
+    """Igual que marcar_cambios_catalogo para INSERT/UPDATE/DELETE masivos (importador, stock)"""
+    if estado.is_insert or estado.is_update or estado.is_delete:
+        mapper = estado.bind_mapper
+        if mapper is not None and issubclass(mapper.class_, MODELOS_CATALOGO):
+            estado.session.info['catalogo_modificado'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def incrementar_version_catalogo(sesion):
+    if sesion.info.pop('catalogo_modificado', False):
+        version_catalogo.incrementar()
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def descartar_cambios_catalogo(sesion, transaccion_previa):
+    sesion.info.pop('catalogo_modificado', None)
+
+class ImagenAlmacenada(db.Model):
+    """Imágenes subidas, indexadas por el SHA-256 de su contenido, con contador de referencias"""
+    __tablename__ = 'imagen_almacenada'
+    
+    hash = db.Column(db.String(64), primary_key=True)
+    url = db.Column(db.String(500), nullable=False, unique=True)
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @staticmethod
+    def reutilizar(huella, referencias=1):
+        """Suma `referencias` a la imagen con ese hash y devuelve su URL (None si no existe)"""
+        actualizadas = db.session.execute(
+            update(ImagenAlmacenada)
+            .where(ImagenAlmacenada.hash == huella)
+            .values(referencias=ImagenAlmacenada.referencias + referencias)
+        ).rowcount
+        if not actualizadas:
+            return None
+        return db.session.query(ImagenAlmacenada.url).filter_by(hash=huella).scalar()
+    
+    @staticmethod
+    def registrar(huella, url, referencias=1):
+        """Registra una imagen recién subida con `referencias` referencias.
+        
+        Devuelve la URL registrada para el hash, que es la de otra subida simultánea
+        del mismo contenido si esta se registró antes.
+        """
+        dialecto = db.session.get_bind().dialect.name
+        if dialecto in ('sqlite', 'postgresql'):
+            insertar = sqlite_insert if dialecto == 'sqlite' else postgresql_insert
+            stmt = insertar(ImagenAlmacenada).values(
+                hash=huella, url=url, referencias=referencias, fecha_creacion=datetime.utcnow()
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['hash'],
+                set_={'referencias': ImagenAlmacenada.referencias + referencias}
+            )
+            db.session.execute(stmt)
+        elif not ImagenAlmacenada.reutilizar(huella, referencias):
+            db.session.add(ImagenAlmacenada(hash=huella, url=url, referencias=referencias))
+            db.session.flush()
+        return db.session.query(ImagenAlmacenada.url).filter_by(hash=huella).scalar()
+    
+    @staticmethod
+    def liberar(url):
+        """Quita una referencia a la imagen y devuelve las que le quedan.
+        
+        Devuelve None si la URL no está registrada (imágenes subidas antes de existir
+        este índice o guardadas como URL externa).
+        """
+        huella = db.session.query(ImagenAlmacenada.hash).filter_by(url=url).scalar()
+        if huella is None:
+            return None
+        db.session.execute(
+            update(ImagenAlmacenada)
+            .where(ImagenAlmacenada.hash == huella, ImagenAlmacenada.referencias > 0)
+            .values(referencias=ImagenAlmacenada.referencias - 1)
+        )
+        return db.session.query(ImagenAlmacenada.referencias).filter_by(hash=huella).scalar()
+    
+    @staticmethod
+    def olvidar(url):
+        """Borra el registro si sigue sin referencias; False si otra subida lo reutilizó"""
+        return db.session.execute(
+            delete(ImagenAlmacenada)
+            .where(ImagenAlmacenada.url == url, ImagenAlmacenada.referencias <= 0)
+        ).rowcount == 1
+
+class ImagenPorEliminar(db.Model):
+    """Cola de imágenes a eliminar del almacenamiento, procesada en lotes en segundo plano"""
+    __tablename__ = 'imagen_por_eliminar'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(500), nullable=False)
+    # Clave del archivo en el almacenamiento (public_id en Cloudinary): varias URLs
+    # (distinta versión, transformaciones) pueden apuntar al mismo archivo
+    identificador = db.Column(db.String(500), index=True)
+    estado = db.Column(db.String(20), default='pendiente', index=True)  # pendiente, eliminando, eliminada, cancelada, fallida
+    intentos = db.Column(db.Integer, default=0)
+    proximo_intento = db.Column(db.DateTime, default=datetime.utcnow)
+    ultimo_error = db.Column(db.Text)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_eliminacion = db.Column(db.DateTime)
+
+class MensajeWhatsApp(db.Model):
+    """Outbox de mensajes de WhatsApp pendientes de envío"""
+    __tablename__ = 'mensaje_whatsapp'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    destinatario = db.Column(db.String(20))  # None = número del administrador
+    mensaje = db.Column(db.Text, nullable=False)
+    estado = db.Column(db.String(20), default='pendiente', index=True)  # pendiente, enviando, enviado, fallido
+    intentos = db.Column(db.Integer, default=0)
+    proximo_intento = db.Column(db.DateTime, default=datetime.utcnow)
+    ultimo_error = db.Column(db.Text)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_envio = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'destinatario': self.destinatario,
+            'mensaje': self.mensaje,
+            'estado': self.estado,
+            'intentos': self.intentos,
+            'proximo_intento': self.proximo_intento.isoformat() if self.proximo_intento else None,
+            'ultimo_error': self.ultimo_error,
+            'fecha_creacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            'fecha_envio': self.fecha_envio.isoformat() if self.fecha_envio else None
+        }
+
+class TrabajoCancelado(Exception):
+    """Se lanza dentro de un trabajo cuando el usuario solicitó cancelarlo"""
+
+class Trabajo(db.Model):
+    """Trabajo en segundo plano con su progreso (importaciones, exportaciones, verificación de imágenes)"""
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    estado = db.Column(db.String(20), default='pendiente')  # pendiente, en_proceso, completado, error, cancelado
+    total = db.Column(db.Integer, default=0)
+    procesados = db.Column(db.Integer, default=0)
+    errores = db.Column(db.Text)  # JSON con los primeros errores encontrados
+    total_errores = db.Column(db.Integer, default=0)
+    cancelacion_solicitada = db.Column(db.Boolean, default=False)
+    archivo = db.Column(db.String(500))  # Archivo de entrada o de salida del trabajo
+    resultado = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def actualizar_progreso(self, procesados, total=None, errores=None):
+        """Guarda el avance del trabajo y lanza TrabajoCancelado si se solicitó cancelarlo"""
+        self.procesados = procesados
+        if total is not None:
+            self.total = total
+        if errores is not None:
+            self.errores = json.dumps(errores[:100])
+            self.total_errores = len(errores)
+        self.fecha_actualizacion = datetime.utcnow()
+        db.session.commit()
+        
+        # El commit expira el objeto, así que la bandera se lee de nuevo desde la base de datos
+        if self.cancelacion_solicitada:
+            raise TrabajoCancelado()
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'estado': self.estado,
+            'total': self.total,
+            'procesados': self.procesados,
+            'progreso': round(self.procesados * 100 / self.total, 1) if self.total else 0,
+            'errores': json.loads(self.errores) if self.errores else [],
+            'total_errores': self.total_errores or 0,
+            'cancelacion_solicitada': bool(self.cancelacion_solicitada),
+            'resultado': json.loads(self.resultado) if self.resultado else None,
+            'error': self.error,
+            'fecha_creacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            'fecha_actualizacion': self.fecha_actualizacion.isoformat() if self.fecha_actualizacion else None
+        }
+
+# Colores de la tienda y sus valores por defecto
+COLORES_DEFAULT = {
+    'color_primario': '#007bff',
+    'color_secundario': '#6c757d',
+    'color_exito': '#28a745',
+    'color_peligro': '#dc3545',
+    'color_advertencia': '#ffc107',
+    'color_info': '#17a2b8',
+    'color_fondo': '#ffffff',
+    'color_texto': '#333333',
+    'color_fondo_secundario': '#f8f9fa',
+    'color_borde': '#dee2e6'
+}
+
+# Descripciones de las claves de configuración general
+DESCRIPCIONES_CONFIGURACION = {
+    'nombre_tienda': 'Nombre de la tienda que aparece en el encabezado',
+    'descripcion_tienda': 'Descripción de la tienda que aparece en la página principal',
+    'whatsapp_admin': 'Número de WhatsApp del administrador para contacto',
+    'logo_url': 'URL del logo de la tienda',
+    'banner_url': 'URL del banner de anuncio',
+    'banner_text': 'Texto del banner de anuncio',
+    'banner_activo': 'Estado del banner (activo/inactivo)'
+}
+
 # Función para cargar usuarios (requerida por Flask-Login)
 @login_manager.user_loader
 def load_user(user_id):
@@ -240,12 +803,77 @@ def load_user(user_id):
 WHATSAPP_TOKEN = os.environ.get('WHATSAPP_TOKEN')
 WHATSAPP_PHONE_ID = os.environ.get('WHATSAPP_PHONE_ID')
 WHATSAPP_RECIPIENT = os.environ.get('WHATSAPP_RECIPIENT')  # Tu número de WhatsApp
+WHATSAPP_API_URL = os.environ.get('WHATSAPP_API_URL', 'https://graph.facebook.com/v17.0')
+WHATSAPP_TIMEOUT = float(os.environ.get('WHATSAPP_TIMEOUT', 10))
+
+# Configuración del outbox de WhatsApp
+WHATSAPP_MAX_INTENTOS = int(os.environ.get('WHATSAPP_MAX_INTENTOS', 5))
+WHATSAPP_BACKOFF_BASE = int(os.environ.get('WHATSAPP_BACKOFF_BASE', 30))  # Segundos antes del primer reintento
+WHATSAPP_INTERVALO_DESPACHO = int(os.environ.get('WHATSAPP_INTERVALO_DESPACHO', 5))
+WHATSAPP_DESPACHADOR_HILO = os.environ.get('WHATSAPP_DESPACHADOR_HILO', 'true').lower() == 'true'
 
 # Configuración de Cloudinary
 CLOUDINARY_CLOUD_NAME = os.environ.get('CLOUDINARY_CLOUD_NAME')
 CLOUDINARY_API_KEY = os.environ.get('CLOUDINARY_API_KEY')
 CLOUDINARY_API_SECRET = os.environ.get('CLOUDINARY_API_SECRET')
 
+# Almacenamiento de imágenes: cloudinary o local (disco del servidor, servido en /medios)
+ALMACENAMIENTO_IMAGENES = os.environ.get('ALMACENAMIENTO_IMAGENES', 'cloudinary')
+DIRECTORIO_MEDIOS = os.environ.get('DIRECTORIO_MEDIOS', os.path.join(basedir, 'instance', 'medios'))
+MEDIOS_CACHE_MAX_AGE = 365 * 24 * 3600
+
+# Eliminación de imágenes en segundo plano y barrido de imágenes huérfanas
+CARPETAS_IMAGENES = ('tienda_productos', 'logos', 'banners')
+IMAGENES_ELIMINACION_LOTE = int(os.environ.get('IMAGENES_ELIMINACION_LOTE', 100))
+IMAGENES_ELIMINACION_INTERVALO = int(os.environ.get('IMAGENES_ELIMINACION_INTERVALO', 30))
+IMAGENES_ELIMINACION_MAX_INTENTOS = int(os.environ.get('IMAGENES_ELIMINACION_MAX_INTENTOS', 5))
+IMAGENES_DESPACHADOR_HILO = os.environ.get('IMAGENES_DESPACHADOR_HILO', 'true').lower() == 'true'
+IMAGENES_BARRIDO_HORAS = float(os.environ.get('IMAGENES_BARRIDO_HORAS', 0))  # 0 = sin barrido periódico
+IMAGENES_HUERFANAS_GRACIA_HORAS = float(os.environ.get('IMAGENES_HUERFANAS_GRACIA_HORAS', 24))
+
+# Las imágenes se reducen y recodifican localmente antes de subirlas (ver imagenes.py)
+IMAGEN_FORMATO = os.environ.get('IMAGEN_FORMATO', 'WEBP')
+IMAGEN_CALIDAD = int(os.environ.get('IMAGEN_CALIDAD', 82))
+
+def leer_anchos_variantes(valor):
+    """Anchos enteros positivos de una lista separada por comas; ignora los demás con un aviso"""
+    anchos = set()
+    for ancho in valor.split(','):
+        ancho = ancho.strip()
+        if not ancho:
+            continue
+        if not ancho.isdigit() or int(ancho) == 0:
+            print(f"⚠️ IMAGEN_ANCHOS_VARIANTES: se ignora el ancho no válido '{ancho}'")
+            continue
+        anchos.add(int(ancho))
+    return tuple(sorted(anchos))
+
+# Anchos de las variantes reducidas que se ofrecen en srcset (además del original)
+IMAGEN_ANCHOS_VARIANTES = leer_anchos_variantes(os.environ.get('IMAGEN_ANCHOS_VARIANTES', '320,480,640'))
+# Las imágenes se guardan con su ancho real al final del nombre (`..._<hash>_<uuid>_800w`)
+ANCHO_EN_NOMBRE = re.compile(r'_[0-9a-f]{16}_[0-9a-f]{8}_(\d+)w\.')
+# Ancho con el que se muestra la tarjeta de producto según la grilla de index.html
+# (col-lg-3, col-md-4 y una columna en móvil)
+SIZES_TARJETA_PRODUCTO = '(min-width: 992px) 25vw, (min-width: 768px) 33vw, 100vw'
+
+# Verificación de imágenes: hilos en paralelo y vigencia de los resultados en caché
+IMAGENES_VERIFICACION_HILOS = int(os.environ.get('IMAGENES_VERIFICACION_HILOS', 8))
+IMAGENES_CACHE_TTL = int(os.environ.get('IMAGENES_CACHE_TTL', 3600))
+cache_verificacion_imagenes = CacheTTL(ttl=IMAGENES_CACHE_TTL, max_entradas=10000)
+
+# Directorio para los archivos de los trabajos en segundo plano (importaciones y exportaciones)
+DIRECTORIO_TRABAJOS = os.environ.get('DIRECTORIO_TRABAJOS', os.path.join(basedir, 'instance', 'trabajos'))
+# Horas que se conservan los archivos de exportación; la limpieza corre cada hora en segundo plano
+TRABAJOS_RETENCION_HORAS = float(os.environ.get('TRABAJOS_RETENCION_HORAS', 24))
+TRABAJOS_LIMPIEZA_HILO = os.environ.get('TRABAJOS_LIMPIEZA_HILO', 'true').lower() == 'true'
+
+# Sesión HTTP compartida para reutilizar conexiones en las verificaciones
+sesion_http = requests.Session()
+sesion_http.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=IMAGENES_VERIFICACION_HILOS,
+    pool_maxsize=IMAGENES_VERIFICACION_HILOS
+))
+
 # Configurar Cloudinary
 cloudinary.config(
     cloud_name=CLOUDINARY_CLOUD_NAME,
@@ -253,78 +881,215 @@ cloudinary.config(
     api_secret=CLOUDINARY_API_SECRET
 )
 
+if ALMACENAMIENTO_IMAGENES == 'local':
+    almacenamiento = AlmacenamientoLocal(DIRECTORIO_MEDIOS)
+else:
+    almacenamiento = AlmacenamientoCloudinary(CLOUDINARY_CLOUD_NAME, CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET)
+
+def enviar_mensaje_whatsapp(numero, mensaje):
+    """Envía un mensaje de texto por la API de WhatsApp Business y retorna (enviado, error)"""
+    url = f"{WHATSAPP_API_URL}/{WHATSAPP_PHONE_ID}/messages"
+    headers = {
+        'Authorization': f'Bearer {WHATSAPP_TOKEN}',
+        'Content-Type': 'application/json'
+    }
+    
+    data = {
+        "messaging_product": "whatsapp",
+        "to": numero,
+        "type": "text",
+        "text": {"body": mensaje}
+    }
+    
+    try:
+        response = requests.post(url, headers=headers, json=data, timeout=WHATSAPP_TIMEOUT)
+        if response.status_code == 200:
+            return True, None
+        return False, f"HTTP {response.status_code}: {response.text}"
+    except Exception as e:
+        return False, str(e)
+
 def enviar_whatsapp(mensaje):
-    """Envía un mensaje por WhatsApp usando la API de Twilio"""
+    """Envía un mensaje por WhatsApp al administrador y retorna (enviado, error)"""
     if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_ID or not WHATSAPP_RECIPIENT:
         print("⚠️ Configuración de WhatsApp no encontrada. Mensaje simulado:")
         print(f"📱 WhatsApp: {mensaje}")
-        return True
+        return True, None
     
-    try:
-        url = f"https://graph.facebook.com/v17.0/{WHATSAPP_PHONE_ID}/messages"
-        headers = {
-            'Authorization': f'Bearer {WHATSAPP_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            "messaging_product": "whatsapp",
-            "to": WHATSAPP_RECIPIENT,
-            "type": "text",
-            "text": {"body": mensaje}
-        }
-        
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code == 200:
-            print("✅ Mensaje enviado a WhatsApp exitosamente")
-            return True
-        else:
-            print(f"❌ Error al enviar WhatsApp: {response.text}")
-            return False
-    except Exception as e:
-        print(f"❌ Error al enviar WhatsApp: {str(e)}")
-        return False
+    enviado, error = enviar_mensaje_whatsapp(WHATSAPP_RECIPIENT, mensaje)
+    if enviado:
+        print("✅ Mensaje enviado a WhatsApp exitosamente")
+    else:
+        print(f"❌ Error al enviar WhatsApp: {error}")
+    return enviado, error
 
 def enviar_whatsapp_cliente(numero_cliente, mensaje):
-    """Envía un mensaje por WhatsApp directamente al cliente"""
+    """Envía un mensaje por WhatsApp directamente al cliente y retorna (enviado, error)"""
     if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_ID:
         print("⚠️ Configuración de WhatsApp no encontrada. Mensaje simulado:")
         print(f"📱 WhatsApp a {numero_cliente}: {mensaje}")
-        return True
+        return True, None
     
-    try:
-        # Limpiar el número del cliente (remover espacios, guiones, etc.)
-        numero_limpio = ''.join(filter(str.isdigit, numero_cliente))
-        if not numero_limpio.startswith('51'):  # Si no tiene código de país, agregar Perú
-            numero_limpio = '51' + numero_limpio
-        
-        url = f"https://graph.facebook.com/v17.0/{WHATSAPP_PHONE_ID}/messages"
-        headers = {
-            'Authorization': f'Bearer {WHATSAPP_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            "messaging_product": "whatsapp",
-            "to": numero_limpio,
-            "type": "text",
-            "text": {"body": mensaje}
-        }
+    # Limpiar el número del cliente (remover espacios, guiones, etc.)
+    numero_limpio = ''.join(filter(str.isdigit, numero_cliente))
+    if not numero_limpio.startswith('51'):  # Si no tiene código de país, agregar Perú
+        numero_limpio = '51' + numero_limpio
+    
+    enviado, error = enviar_mensaje_whatsapp(numero_limpio, mensaje)
+    if enviado:
+        print(f"✅ Mensaje enviado a cliente {numero_cliente} exitosamente")
+    else:
+        print(f"❌ Error al enviar WhatsApp a cliente: {error}")
+    return enviado, error
+
+def encolar_whatsapp(mensaje, destinatario=None):
+    """Agrega un mensaje al outbox de WhatsApp dentro de la transacción actual.
+    
+    Sin destinatario el mensaje va al administrador. El envío lo realiza el
+    despachador en segundo plano una vez que la transacción se confirma.
+    """
+    mensaje_outbox = MensajeWhatsApp(destinatario=destinatario, mensaje=mensaje)
+    db.session.add(mensaje_outbox)
+    return mensaje_outbox
+
+def procesar_outbox_whatsapp(limite=20):
+    """Envía los mensajes pendientes del outbox cuyo próximo intento ya venció.
+    
+    Cada mensaje se reclama con un UPDATE condicional antes de enviarlo, de modo
+    que varios workers pueden procesar el outbox sin enviar un mensaje dos veces.
+    Un mensaje que queda en 'enviando' (worker caído) vuelve a ser elegible cuando
+    vence su plazo. Los errores se reintentan con backoff exponencial y tras
+    WHATSAPP_MAX_INTENTOS el mensaje queda como 'fallido'. Retorna la cantidad procesada.
+    """
+    ahora = datetime.utcnow()
+    elegibles = (
+        MensajeWhatsApp.estado.in_(('pendiente', 'enviando')),
+        MensajeWhatsApp.proximo_intento <= ahora
+    )
+    ids = [
+        mensaje_id for (mensaje_id,) in db.session.query(MensajeWhatsApp.id)
+            .filter(*elegibles)
+            .order_by(MensajeWhatsApp.id)
+            .limit(limite)
+            .all()
+    ]
+    
+    procesados = 0
+    for mensaje_id in ids:
+        # Reclamar el mensaje; el plazo cubre el tiempo máximo de un envío
+        reclamado = db.session.execute(
+            update(MensajeWhatsApp)
+            .where(MensajeWhatsApp.id == mensaje_id, *elegibles)
+            .values(estado='enviando', proximo_intento=ahora + timedelta(seconds=WHATSAPP_TIMEOUT * 3))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if reclamado.rowcount != 1:
+            continue
         
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code == 200:
-            print(f"✅ Mensaje enviado a cliente {numero_cliente} exitosamente")
-            return True
+        mensaje = db.session.get(MensajeWhatsApp, mensaje_id)
+        if mensaje.destinatario:
+            enviado, error = enviar_whatsapp_cliente(mensaje.destinatario, mensaje.mensaje)
         else:
-            print(f"❌ Error al enviar WhatsApp a cliente: {response.text}")
-            return False
-    except Exception as e:
-        print(f"❌ Error al enviar WhatsApp a cliente: {str(e)}")
-        return False
+            enviado, error = enviar_whatsapp(mensaje.mensaje)
+        
+        mensaje.intentos = (mensaje.intentos or 0) + 1
+        if enviado:
+            mensaje.estado = 'enviado'
+            mensaje.fecha_envio = datetime.utcnow()
+            mensaje.ultimo_error = None
+        elif mensaje.intentos >= WHATSAPP_MAX_INTENTOS:
+            mensaje.estado = 'fallido'
+            mensaje.ultimo_error = error
+        else:
+            mensaje.estado = 'pendiente'
+            mensaje.ultimo_error = error
+            espera = WHATSAPP_BACKOFF_BASE * (2 ** (mensaje.intentos - 1))
+            mensaje.proximo_intento = datetime.utcnow() + timedelta(seconds=espera)
+        db.session.commit()
+        procesados += 1
+    
+    return procesados
+
+class Despachador:
+    """Hilo en segundo plano que llama a `procesar()` cada `intervalo` segundos
+    (o al despertarlo) y repite mientras devuelva algo procesado"""
+    
+    def __init__(self, nombre, procesar, intervalo=5):
+        self.nombre = nombre
+        self.procesar = procesar
+        self.intervalo = intervalo
+        self._evento = threading.Event()
+        self._hilo = None
+    
+    def iniciar(self):
+        """Inicia el hilo si no está en ejecución"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._hilo = threading.Thread(target=self._ejecutar, name=f'despachador-{self.nombre}', daemon=True)
+        self._hilo.start()
+    
+    def despertar(self):
+        """Procesa de inmediato en lugar de esperar al siguiente intervalo"""
+        self._evento.set()
+    
+    def _ejecutar(self):
+        while True:
+            self._evento.wait(self.intervalo)
+            self._evento.clear()
+            try:
+                with app.app_context():
+                    while self.procesar():
+                        pass
+            except Exception as e:
+                print(f"❌ Error en el despachador {self.nombre}: {str(e)}")
+
+despachador_whatsapp = Despachador('whatsapp', procesar_outbox_whatsapp, intervalo=WHATSAPP_INTERVALO_DESPACHO)
 
-def subir_imagen_cloudinary(archivo, nombre_producto=''):
-    """Sube una imagen a Cloudinary y devuelve la URL pública"""
-    if not CLOUDINARY_CLOUD_NAME or not CLOUDINARY_API_KEY or not CLOUDINARY_API_SECRET:
+def guardar_imagen(imagen, carpeta, prefijo='', referenciar=True):
+    """Guarda una imagen procesada y devuelve su URL, sin volver a subir contenido repetido.
+    
+    Las imágenes se identifican por el SHA-256 de los bytes ya normalizados: si el
+    mismo contenido ya está almacenado se devuelve su URL. El nombre del archivo se
+    deriva del hash (con `prefijo` para hacerlo legible) y termina con el ancho real
+    de la imagen, que imagen_responsiva usa para armar el srcset.
+    
+    Cada subida recibe un nombre único: una imagen que vuelve a subirse mientras
+    su copia anterior espera en la cola de eliminación no puede caer en el mismo
+    archivo. Con `referenciar` se suma una referencia, que el llamador debe guardar en su
+    commit (producto, logo o banner) y liberar con eliminar_imagen_cloudinary al
+    reemplazarla. La subida al almacenamiento se hace fuera de cualquier SAVEPOINT,
+    para no retener bloqueos mientras dura; solo la consulta y el registro van en
+    SAVEPOINTs, que se confirman con la transacción del llamador y no tocan sus
+    cambios pendientes.
+    """
+    huella = hashlib.sha256(imagen.datos).hexdigest()
+    referencias = 1 if referenciar else 0
+    with db.session.begin_nested():
+        url = ImagenAlmacenada.reutilizar(huella, referencias)
+    if url:
+        print(f"♻️ Imagen repetida, se reutiliza: {url}")
+        return url
+    
+    sufijo = f"{huella[:16]}_{uuid.uuid4().hex[:8]}_{imagen.ancho}w"
+    nombre = f"{prefijo}_{sufijo}" if prefijo else sufijo
+    url_subida = almacenamiento.guardar(imagen.datos, carpeta, nombre, imagen.extension)
+    try:
+        with db.session.begin_nested():
+            url = ImagenAlmacenada.registrar(huella, url_subida, referencias)
+    except Exception:
+        # Sin registro nadie referenciaría el archivo subido
+        almacenamiento.eliminar(url_subida)
+        raise
+    
+    if url != url_subida:
+        # Otra subida simultánea del mismo contenido se registró antes: sobra esta copia
+        almacenamiento.eliminar(url_subida)
+    return url
+
+def subir_imagen_cloudinary(archivo, nombre_producto='', referenciar=True):
+    """Sube una imagen de producto al almacenamiento configurado y devuelve la URL pública"""
+    if not almacenamiento.configurado():
         print("⚠️ Configuración de Cloudinary no encontrada")
         return None
     
@@ -335,43 +1100,25 @@ def subir_imagen_cloudinary(archivo, nombre_producto=''):
         if not archivo or not archivo.filename:
             return None
         
-        # Obtener extensión del archivo
-        extension = os.path.splitext(archivo.filename)[1].lower()
-        extensiones_permitidas = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
-        
-        if extension not in extensiones_permitidas:
-            print(f"❌ Extensión no permitida: {extension}")
+        # Validar por contenido, reducir a 800x600 y quitar metadatos antes de subir
+        try:
+            imagen = procesar_imagen(archivo, TAMANO_PRODUCTO, IMAGEN_FORMATO, IMAGEN_CALIDAD)
+        except ImagenInvalida as e:
+            print(f"❌ Imagen rechazada: {e}")
             return None
         
-        # Generar nombre único para el archivo
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         nombre_seguro = secure_filename(nombre_producto.replace(' ', '_')) if nombre_producto else 'producto'
-        public_id = f"tienda_productos/{nombre_seguro}_{timestamp}_{uuid.uuid4().hex[:8]}"
-        
-        # Subir a Cloudinary
-        result = cloudinary.uploader.upload(
-            archivo,
-            public_id=public_id,
-            folder="tienda_productos",
-            resource_type="image",
-            transformation=[
-                {"width": 800, "height": 600, "crop": "limit"},
-                {"quality": "auto"},
-                {"format": "auto"}
-            ]
-        )
-        
-        url_publica = result['secure_url']
-        print(f"✅ Imagen subida exitosamente a Cloudinary: {url_publica}")
+        url_publica = guardar_imagen(imagen, 'tienda_productos', nombre_seguro, referenciar)
+        print(f"✅ Imagen subida exitosamente ({almacenamiento.nombre}): {url_publica}")
         return url_publica
         
     except Exception as e:
-        print(f"❌ Error al subir imagen a Cloudinary: {str(e)}")
+        print(f"❌ Error al subir imagen ({almacenamiento.nombre}): {str(e)}")
         return None
 
 def subir_logo_cloudinary(archivo):
-    """Sube un logo a Cloudinary y retorna la URL y error"""
-    if not CLOUDINARY_CLOUD_NAME or not CLOUDINARY_API_KEY or not CLOUDINARY_API_SECRET:
+    """Sube un logo al almacenamiento configurado y retorna la URL y error"""
+    if not almacenamiento.configurado():
         return None, "Configuración de Cloudinary no encontrada"
     
     try:
@@ -379,36 +1126,22 @@ def subir_logo_cloudinary(archivo):
         if not archivo or not archivo.filename:
             return None, "No se seleccionó ningún archivo"
         
-        # Verificar extensión del archivo
-        extensiones_permitidas = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-        if '.' not in archivo.filename or archivo.filename.rsplit('.', 1)[1].lower() not in extensiones_permitidas:
-            return None, "Formato de archivo no permitido. Use PNG, JPG, JPEG, GIF o WEBP"
-        
-        # Generar nombre único para el archivo
-        nombre_archivo = f"logos/{uuid.uuid4().hex}"
-        
-        # Subir a Cloudinary
-        resultado = cloudinary.uploader.upload(
-            archivo,
-            public_id=nombre_archivo,
-            folder="logos",
-            resource_type="image",
-            transformation=[
-                {'width': 300, 'height': 300, 'crop': 'limit'},
-                {'quality': 'auto'},
-                {'format': 'auto'}
-            ]
-        )
+        # Validar por contenido, reducir y quitar metadatos antes de subir
+        try:
+            imagen = procesar_imagen(archivo, TAMANO_LOGO, IMAGEN_FORMATO, IMAGEN_CALIDAD)
+        except ImagenInvalida as e:
+            return None, str(e)
         
-        return resultado['secure_url'], None
+        url = guardar_imagen(imagen, 'logos')
+        return url, None
         
     except Exception as e:
-        print(f"❌ Error al subir logo a Cloudinary: {str(e)}")
+        print(f"❌ Error al subir logo ({almacenamiento.nombre}): {str(e)}")
         return None, f"Error al subir logo: {str(e)}"
 
 def subir_banner_cloudinary(archivo):
-    """Sube un banner a Cloudinary y retorna la URL y error"""
-    if not CLOUDINARY_CLOUD_NAME or not CLOUDINARY_API_KEY or not CLOUDINARY_API_SECRET:
+    """Sube un banner al almacenamiento configurado y retorna la URL y error"""
+    if not almacenamiento.configurado():
         return None, "Configuración de Cloudinary no encontrada"
     
     try:
@@ -416,77 +1149,486 @@ def subir_banner_cloudinary(archivo):
         if not archivo or not archivo.filename:
             return None, "No se seleccionó ningún archivo"
         
-        # Verificar extensión del archivo
-        extensiones_permitidas = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-        if '.' not in archivo.filename or archivo.filename.rsplit('.', 1)[1].lower() not in extensiones_permitidas:
-            return None, "Formato de archivo no permitido. Use PNG, JPG, JPEG, GIF o WEBP"
-        
-        # Generar nombre único para el archivo
-        nombre_archivo = f"banners/{uuid.uuid4().hex}"
-        
-        # Subir a Cloudinary
-        resultado = cloudinary.uploader.upload(
-            archivo,
-            public_id=nombre_archivo,
-            folder="banners",
-            resource_type="image",
-            transformation=[
-                {'width': 1200, 'height': 300, 'crop': 'limit'},
-                {'quality': 'auto'},
-                {'format': 'auto'}
-            ]
-        )
+        # Validar por contenido, reducir y quitar metadatos antes de subir
+        try:
+            imagen = procesar_imagen(archivo, TAMANO_BANNER, IMAGEN_FORMATO, IMAGEN_CALIDAD)
+        except ImagenInvalida as e:
+            return None, str(e)
         
-        return resultado['secure_url'], None
+        url = guardar_imagen(imagen, 'banners')
+        return url, None
         
     except Exception as e:
-        print(f"❌ Error al subir banner a Cloudinary: {str(e)}")
+        print(f"❌ Error al subir banner ({almacenamiento.nombre}): {str(e)}")
         return None, f"Error al subir banner: {str(e)}"
 
 def verificar_imagen_cloudinary(url):
-    """Verifica si una imagen de Cloudinary existe"""
+    """Verifica si una imagen existe (en disco si es del almacenamiento local, si no por HTTP).
+    
+    Retorna True o False solo ante una respuesta definitiva (200, o 404/410); ante
+    errores de red, timeouts o respuestas 5xx retorna None (no se pudo verificar).
+    """
+    ruta = almacenamiento.ruta_local(url)
+    if ruta is not None:
+        return os.path.isfile(ruta)
     try:
-        response = requests.head(url, timeout=10)
-        return response.status_code == 200
-    except:
+        response = sesion_http.head(url, timeout=10)
+    except requests.RequestException as e:
+        print(f"⚠️ No se pudo verificar la imagen {url}: {str(e)}")
+        return None
+    if response.status_code == 200:
+        return True
+    if response.status_code in (404, 410):
         return False
+    return None
+
+def verificar_imagenes(urls, incremental=True, al_avanzar=None):
+    """Verifica varias URLs en paralelo y retorna un diccionario url -> existe.
+    
+    `existe` es None si la URL no pudo verificarse; esos resultados no se guardan
+    en caché, así que se vuelven a consultar en la siguiente verificación.
+    En modo incremental solo se consultan las URLs sin resultado vigente en la caché.
+    `al_avanzar(procesadas, total)` se llama periódicamente para informar el progreso.
+    """
+    resultados = {}
+    pendientes = []
+    for url in set(urls):
+        encontrado, existe = cache_verificacion_imagenes.obtener(url) if incremental else (False, None)
+        if encontrado:
+            resultados[url] = existe
+        else:
+            pendientes.append(url)
+    
+    total = len(resultados) + len(pendientes)
+    if al_avanzar:
+        al_avanzar(len(resultados), total)
+    
+    with ThreadPoolExecutor(max_workers=IMAGENES_VERIFICACION_HILOS) as ejecutor:
+        futuros = {ejecutor.submit(verificar_imagen_cloudinary, url): url for url in pendientes}
+        try:
+            for i, futuro in enumerate(as_completed(futuros), 1):
+                url = futuros[futuro]
+                resultados[url] = futuro.result()
+                if resultados[url] is not None:
+                    cache_verificacion_imagenes.guardar(url, resultados[url])
+                if al_avanzar and (i % 20 == 0 or i == len(pendientes)):
+                    al_avanzar(total - len(pendientes) + i, total)
+        except BaseException:
+            # Si el trabajo se cancela, no seguir verificando las URLs restantes
+            ejecutor.shutdown(wait=False, cancel_futures=True)
+            raise
+    
+    return resultados
+
+def reporte_imagenes_productos(incremental=True, al_avanzar=None):
+    """Genera el reporte de estado de las imágenes de todos los productos"""
+    productos = db.session.query(Producto.id, Producto.nombre, Producto.imagen).order_by(Producto.id).all()
+    existentes = verificar_imagenes(
+        [producto.imagen for producto in productos if producto.imagen],
+        incremental=incremental,
+        al_avanzar=al_avanzar
+    )
+    
+    resultados = []
+    for producto in productos:
+        if producto.imagen:
+            existe = existentes[producto.imagen]
+            resultados.append({
+                'id': producto.id,
+                'nombre': producto.nombre,
+                'imagen_url': producto.imagen,
+                'existe': existe,
+                'status': 'DESCONOCIDO' if existe is None else ('OK' if existe else 'ERROR')
+            })
+        else:
+            resultados.append({
+                'id': producto.id,
+                'nombre': producto.nombre,
+                'imagen_url': None,
+                'existe': False,
+                'status': 'SIN_IMAGEN'
+            })
+    return resultados
+
+def iniciar_trabajo(tipo, funcion, *args, archivo_entrada=None):
+    """Crea un Trabajo y ejecuta `funcion(trabajo, *args)` en un hilo en segundo plano.
+    
+    El valor retornado por la función se guarda como resultado del trabajo.
+    `archivo_entrada` (por ejemplo el archivo subido de una importación) se elimina
+    al terminar el trabajo, también si se cancela antes de empezar o si falla.
+    """
+    try:
+        trabajo = Trabajo(tipo=tipo)
+        db.session.add(trabajo)
+        db.session.commit()
+        
+        hilo = threading.Thread(target=_ejecutar_trabajo, args=(trabajo.id, funcion, args, archivo_entrada), daemon=True)
+        hilo.start()
+    except BaseException:
+        if archivo_entrada and os.path.exists(archivo_entrada):
+            os.remove(archivo_entrada)
+        raise
+    return trabajo
+
+def _ejecutar_trabajo(trabajo_id, funcion, args, archivo_entrada=None):
+    try:
+        with app.app_context():
+            trabajo = db.session.get(Trabajo, trabajo_id)
+            if trabajo.cancelacion_solicitada:
+                trabajo.estado = 'cancelado'
+                db.session.commit()
+                return
+            
+            trabajo.estado = 'en_proceso'
+            db.session.commit()
+            try:
+                resultado = funcion(trabajo, *args)
+                trabajo.estado = 'completado'
+                trabajo.resultado = json.dumps(resultado)
+            except TrabajoCancelado:
+                db.session.rollback()
+                trabajo = db.session.get(Trabajo, trabajo_id)
+                trabajo.estado = 'cancelado'
+                print(f"⚠️ Trabajo {trabajo_id} ({trabajo.tipo}) cancelado")
+            except Exception as e:
+                db.session.rollback()
+                trabajo = db.session.get(Trabajo, trabajo_id)
+                trabajo.estado = 'error'
+                trabajo.error = str(e)
+                print(f"❌ Error en trabajo {trabajo_id} ({trabajo.tipo}): {str(e)}")
+            trabajo.fecha_actualizacion = datetime.utcnow()
+            db.session.commit()
+    finally:
+        if archivo_entrada and os.path.exists(archivo_entrada):
+            os.remove(archivo_entrada)
+
+def limpiar_archivos_trabajos(retencion_horas=TRABAJOS_RETENCION_HORAS):
+    """Elimina los archivos de trabajos con más de `retencion_horas` y retorna cuántos.
+    
+    Los archivos de exportación de trabajos terminados dejan de poder descargarse.
+    También se eliminan los restos en DIRECTORIO_TRABAJOS que ningún trabajo en
+    curso usa (por ejemplo, de un proceso que se detuvo a mitad de un trabajo).
+    """
+    limite = datetime.utcnow() - timedelta(hours=retencion_horas)
+    eliminados = 0
+    
+    vencidos = Trabajo.query.filter(
+        Trabajo.archivo.isnot(None),
+        Trabajo.estado.in_(('completado', 'error', 'cancelado')),
+        Trabajo.fecha_actualizacion < limite
+    ).all()
+    for trabajo in vencidos:
+        if os.path.exists(trabajo.archivo):
+            os.remove(trabajo.archivo)
+            eliminados += 1
+        trabajo.archivo = None
+    db.session.commit()
+    
+    if os.path.isdir(DIRECTORIO_TRABAJOS):
+        en_uso = {
+            archivo for (archivo,) in db.session.query(Trabajo.archivo)
+                .filter(Trabajo.archivo.isnot(None), Trabajo.estado.in_(('pendiente', 'en_proceso')))
+        }
+        for nombre in os.listdir(DIRECTORIO_TRABAJOS):
+            ruta = os.path.join(DIRECTORIO_TRABAJOS, nombre)
+            if ruta in en_uso or not os.path.isfile(ruta):
+                continue
+            if datetime.utcfromtimestamp(os.path.getmtime(ruta)) < limite:
+                os.remove(ruta)
+                eliminados += 1
+    return eliminados
+
+def limpieza_periodica_trabajos():
+    eliminados = limpiar_archivos_trabajos()
+    if eliminados:
+        print(f"🧹 {eliminados} archivos de trabajos vencidos eliminados")
+    return 0  # Una pasada por intervalo
+
+limpieza_trabajos = Despachador('limpieza-trabajos', limpieza_periodica_trabajos, intervalo=3600)
+
+def trabajo_verificar_imagenes(trabajo, incremental=True):
+    """Trabajo en segundo plano que verifica las imágenes de los productos"""
+    return reporte_imagenes_productos(incremental=incremental, al_avanzar=trabajo.actualizar_progreso)
+
+def urls_imagenes_en_uso(urls=None):
+    """URLs de imágenes usadas por productos, banners o la configuración de la tienda.
+    
+    Con `urls` solo se comprueban esas; sin ellas se devuelven todas las usadas.
+    """
+    consultas = (
+        (db.session.query(Producto.imagen), Producto.imagen),
+        (db.session.query(Banner.imagen_url), Banner.imagen_url),
+        (db.session.query(Configuracion.valor).filter(Configuracion.clave.in_(['logo_url', 'banner_url'])), Configuracion.valor),
+    )
+    en_uso = set()
+    for consulta, columna in consultas:
+        if urls is not None:
+            consulta = consulta.filter(columna.in_(list(urls)))
+        en_uso.update(valor for (valor,) in consulta.distinct() if valor)
+    return en_uso
+
+def identificadores_imagenes_en_uso():
+    """Identificadores de almacenamiento de las imágenes usadas o registradas para reutilizarse"""
+    urls = urls_imagenes_en_uso() | {url for (url,) in db.session.query(ImagenAlmacenada.url)}
+    return {almacenamiento.identificador(url) for url in urls if almacenamiento.es_propia(url)}
+
+def encolar_eliminacion_imagen(url):
+    """Agrega la imagen a la cola de eliminación dentro de la transacción actual"""
+    identificador = almacenamiento.identificador(url)
+    pendiente = db.session.query(ImagenPorEliminar.id).filter(
+        ImagenPorEliminar.identificador == identificador,
+        ImagenPorEliminar.estado.in_(('pendiente', 'eliminando'))
+    ).first()
+    if not pendiente:
+        db.session.add(ImagenPorEliminar(url=url, identificador=identificador))
 
 def eliminar_imagen_cloudinary(url_imagen):
-    """Elimina una imagen de Cloudinary basándose en su URL"""
-    if not CLOUDINARY_CLOUD_NAME or not url_imagen:
+    """Quita una referencia a una imagen y, si ya nadie la usa, encola su eliminación.
+    
+    El archivo lo elimina en lotes el despachador de imágenes, fuera de la petición.
+    Confirma su propia transacción, así que debe llamarse después del commit de la
+    operación que dejó de usar la imagen. Las URLs externas se ignoran.
+    """
+    if not url_imagen or not almacenamiento.es_propia(url_imagen):
         return False
     
     try:
-        # Extraer el public_id de la URL de Cloudinary
-        if 'cloudinary.com' not in url_imagen:
-            return False
-        
-        # Extraer public_id de la URL
-        # Formato: https://res.cloudinary.com/cloud_name/image/upload/v1234567890/folder/filename.jpg
-        parts = url_imagen.split('/')
-        if len(parts) < 8:
-            return False
-        
-        # Buscar el public_id después de 'upload/'
-        upload_index = parts.index('upload')
-        if upload_index + 2 >= len(parts):
-            return False
-        
-        public_id = '/'.join(parts[upload_index + 2:]).split('.')[0]  # Remover extensión
-        
-        # Eliminar imagen de Cloudinary
-        result = cloudinary.uploader.destroy(public_id)
-        
-        if result.get('result') == 'ok':
-            print(f"✅ Imagen eliminada de Cloudinary: {public_id}")
-            return True
-        else:
-            print(f"⚠️ No se pudo eliminar imagen de Cloudinary: {result}")
-            return False
-        
+        restantes = ImagenAlmacenada.liberar(url_imagen)
+        # El contador es una pista: la URL también puede estar guardada sin referencia
+        # (JSON, importación, /api/upload-image), así que se comprueba el uso real
+        libre = (restantes is None or restantes <= 0) and not urls_imagenes_en_uso([url_imagen])
+        if libre and restantes is not None:
+            libre = ImagenAlmacenada.olvidar(url_imagen)
+        if libre:
+            encolar_eliminacion_imagen(url_imagen)
+        db.session.commit()
     except Exception as e:
-        print(f"❌ Error al eliminar imagen de Cloudinary: {str(e)}")
+        db.session.rollback()
+        print(f"❌ Error al liberar imagen ({almacenamiento.nombre}): {str(e)}")
         return False
+    
+    if libre:
+        despachador_imagenes.despertar()
+    return libre
+
+def procesar_eliminaciones_imagenes(limite=IMAGENES_ELIMINACION_LOTE):
+    """Elimina del almacenamiento un lote de imágenes de la cola.
+    
+    El lote se reclama con un único UPDATE condicional (igual que el outbox de
+    WhatsApp) y se elimina con una sola llamada por lote al almacenamiento. Justo
+    antes de eliminar se descartan las imágenes cuyo identificador volvió a usarse,
+    con cualquier URL (otra versión o transformación). Los errores se reintentan
+    con backoff y tras IMAGENES_ELIMINACION_MAX_INTENTOS quedan como 'fallida'.
+    Retorna la cantidad procesada.
+    """
+    ahora = datetime.utcnow()
+    elegibles = (
+        ImagenPorEliminar.estado.in_(('pendiente', 'eliminando')),
+        ImagenPorEliminar.proximo_intento <= ahora
+    )
+    ids = [
+        imagen_id for (imagen_id,) in db.session.query(ImagenPorEliminar.id)
+            .filter(*elegibles)
+            .order_by(ImagenPorEliminar.id)
+            .limit(limite)
+            .all()
+    ]
+    if not ids:
+        return 0
+    
+    # El plazo identifica este lote y cubre el tiempo máximo de la eliminación
+    plazo = ahora + timedelta(minutes=5)
+    db.session.execute(
+        update(ImagenPorEliminar)
+        .where(ImagenPorEliminar.id.in_(ids), *elegibles)
+        .values(estado='eliminando', proximo_intento=plazo)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    lote = ImagenPorEliminar.query.filter(
+        ImagenPorEliminar.id.in_(ids),
+        ImagenPorEliminar.estado == 'eliminando',
+        ImagenPorEliminar.proximo_intento == plazo
+    ).all()
+    
+    en_uso = identificadores_imagenes_en_uso()
+    reutilizadas = {
+        imagen.id for imagen in lote
+        if (imagen.identificador or almacenamiento.identificador(imagen.url)) in en_uso
+    }
+    urls = {imagen.url for imagen in lote if imagen.id not in reutilizadas}
+    try:
+        resultados = almacenamiento.eliminar_varias(urls)
+    except Exception as e:
+        resultados = {url: (False, str(e)) for url in urls}
+    
+    for imagen in lote:
+        if imagen.id in reutilizadas:
+            imagen.estado = 'cancelada'
+            continue
+        eliminada, error = resultados[imagen.url]
+        imagen.intentos = (imagen.intentos or 0) + 1
+        if eliminada:
+            imagen.estado = 'eliminada'
+            imagen.fecha_eliminacion = datetime.utcnow()
+            imagen.ultimo_error = None
+        elif imagen.intentos >= IMAGENES_ELIMINACION_MAX_INTENTOS:
+            imagen.estado = 'fallida'
+            imagen.ultimo_error = error
+        else:
+            imagen.estado = 'pendiente'
+            imagen.ultimo_error = error
+            imagen.proximo_intento = datetime.utcnow() + timedelta(seconds=60 * (2 ** (imagen.intentos - 1)))
+    db.session.commit()
+    
+    eliminadas = sum(1 for imagen in lote if imagen.estado == 'eliminada')
+    if eliminadas:
+        print(f"🗑️ {eliminadas} imágenes eliminadas ({almacenamiento.nombre})")
+    return len(lote)
+
+def barrer_imagenes_huerfanas(aplicar=True, gracia_horas=IMAGENES_HUERFANAS_GRACIA_HORAS):
+    """Busca imágenes del almacenamiento que ningún producto, banner o logo usa.
+    
+    Compara el listado de CARPETAS_IMAGENES en el almacenamiento con las URLs
+    guardadas en la base de datos. Solo cuenta las imágenes subidas hace más de
+    `gracia_horas`, porque una imagen recién subida puede no estar asignada todavía.
+    Con `aplicar` encola su eliminación y borra su registro de deduplicación.
+    Retorna la lista de URLs huérfanas.
+    """
+    en_uso = {almacenamiento.identificador(url) for url in urls_imagenes_en_uso() if almacenamiento.es_propia(url)}
+    limite = datetime.utcnow() - timedelta(hours=gracia_horas)
+    huerfanas = [
+        archivo['url']
+        for carpeta in CARPETAS_IMAGENES
+        for archivo in almacenamiento.listar(carpeta)
+        if archivo['identificador'] not in en_uso and archivo['fecha'] < limite
+    ]
+    
+    if aplicar and huerfanas:
+        for inicio in range(0, len(huerfanas), 500):
+            db.session.execute(
+                delete(ImagenAlmacenada).where(ImagenAlmacenada.url.in_(huerfanas[inicio:inicio + 500]))
+            )
+        for url in huerfanas:
+            encolar_eliminacion_imagen(url)
+        db.session.commit()
+        despachador_imagenes.despertar()
+    return huerfanas
+
+def barrido_periodico_imagenes():
+    huerfanas = barrer_imagenes_huerfanas()
+    if huerfanas:
+        print(f"🧹 {len(huerfanas)} imágenes huérfanas encoladas para eliminar")
+    return 0  # Una pasada por intervalo
+
+despachador_imagenes = Despachador('imagenes', procesar_eliminaciones_imagenes, intervalo=IMAGENES_ELIMINACION_INTERVALO)
+barrido_imagenes = Despachador('barrido-imagenes', barrido_periodico_imagenes, intervalo=IMAGENES_BARRIDO_HORAS * 3600)
+
+def agrupar_cantidades(items):
+    """Suma las cantidades de un carrito por producto (ValueError si alguna no es válida)"""
+    cantidades = {}
+    for item in items:
+        producto_id = int(item['producto_id'])
+        cantidad = int(item['cantidad'])
+        if cantidad <= 0:
+            raise ValueError(f'Cantidad inválida para el producto {producto_id}')
+        cantidades[producto_id] = cantidades.get(producto_id, 0) + cantidad
+    return cantidades
+
+def subtotal_linea(precio, cantidad):
+    """Subtotal redondeado de una línea; la cotización y el pedido suman estos valores"""
+    return round(precio * cantidad, 2)
+
+def cotizar_carrito(items):
+    """Cotiza un carrito con los precios y el stock actuales, en una sola consulta IN.
+    
+    Retorna las líneas (una por producto) con precio, stock, disponibilidad y
+    subtotal, el total calculado en el servidor y si el carrito puede pedirse tal cual.
+    """
+    cantidades = agrupar_cantidades(items)
+    productos = {
+        fila.id: fila
+        for fila in db.session.query(
+            Producto.id, Producto.nombre, Producto.precio, Producto.stock, Producto.activo
+        ).filter(Producto.id.in_(list(cantidades)))
+    }
+    
+    lineas = []
+    total = 0
+    for producto_id, cantidad in cantidades.items():
+        producto = productos.get(producto_id)
+        if not producto or not producto.activo:
+            lineas.append({
+                'producto_id': producto_id,
+                'nombre': producto.nombre if producto else None,
+                'precio': None,
+                'cantidad': cantidad,
+                'stock': 0,
+                'disponible': False,
+                'subtotal': 0
+            })
+            continue
+        stock = producto.stock or 0
+        subtotal = subtotal_linea(producto.precio, cantidad)
+        total += subtotal
+        lineas.append({
+            'producto_id': producto_id,
+            'nombre': producto.nombre,
+            'precio': producto.precio,
+            'cantidad': cantidad,
+            'stock': stock,
+            'disponible': stock >= cantidad,
+            'subtotal': subtotal
+        })
+    
+    return {
+        'lineas': lineas,
+        'total': round(total, 2),
+        'valido': all(linea['disponible'] for linea in lineas)
+    }
+
+def reservar_stock(items):
+    """Descuenta de forma atómica el stock de los productos de un carrito.
+    
+    Agrupa las cantidades por producto, carga todos los productos con una sola
+    consulta IN (en PostgreSQL bloquea las filas en orden de id para evitar
+    interbloqueos entre compras simultáneas) y descuenta con UPDATE condicionales
+    `stock = stock - n WHERE stock >= n`, de modo que el stock nunca queda en negativo.
+    Los productos inexistentes o inactivos rechazan el pedido, igual que en
+    cotizar_carrito. Retorna un diccionario id -> Producto y un mensaje de error (o None).
+    """
+    try:
+        cantidades = agrupar_cantidades(items)
+    except ValueError as e:
+        return None, str(e)
+    
+    productos = {
+        producto.id: producto
+        for producto in Producto.query
+            .filter(Producto.id.in_(list(cantidades)))
+            .order_by(Producto.id)
+            .with_for_update()
+            .all()
+    }
+    
+    for producto_id in sorted(cantidades):
+        producto = productos.get(producto_id)
+        if not producto or not producto.activo:
+            nombre = producto.nombre if producto else f'el producto {producto_id}'
+            return None, f'{nombre} ya no está disponible'
+        
+        cantidad = cantidades[producto_id]
+        resultado = db.session.execute(
+            update(Producto)
+            .where(Producto.id == producto_id, Producto.stock >= cantidad)
+            .values(stock=Producto.stock - cantidad)
+            .execution_options(synchronize_session='fetch')
+        )
+        if resultado.rowcount != 1:
+            disponible = db.session.query(Producto.stock).filter_by(id=producto_id).scalar()
+            return None, f'No hay suficiente stock para {producto.nombre}. Stock disponible: {disponible}'
+    
+    return productos, None
 
 # Rutas de autenticación
 @app.route('/login', methods=['GET', 'POST'])
@@ -549,24 +1691,182 @@ def register():
     return render_template('register.html')
 
 # Rutas de la aplicación
+def renderizar_inicio():
+    """Renderiza la página principal de la tienda.
+    
+    Para visitantes anónimos sin mensajes flash pendientes el HTML se guarda con la
+    versión del catálogo como clave, así que se sirve desde memoria sin consultar la
+    base de datos hasta que cambie un producto, categoría, banner o configuración.
+    """
+    publica = not current_user.is_authenticated and '_flashes' not in session
+    clave = ('index', version_catalogo.valor)
+    if publica:
+        encontrado, html = cache_paginas.obtener(clave)
+        if encontrado:
+            return html
+    
+    productos, siguiente_cursor = pagina_catalogo()
+    categorias = Categoria.query.filter_by(activa=True).all()
+    html = render_template('index.html', productos=productos, categorias=categorias,
+                           siguiente_cursor=siguiente_cursor)
+    if publica:
+        cache_paginas.guardar(clave, html)
+    return html
+
 @app.route('/')
 def index():
-    productos = Producto.query.filter_by(activo=True).all()
-    categorias = Categoria.query.filter_by(activa=True).all()
-    return render_template('index.html', productos=productos, categorias=categorias)
+    return renderizar_inicio()
+
+
+# ===== PAGINACIÓN =====
+
+POR_PAGINA_DEFAULT = int(os.environ.get('POR_PAGINA_DEFAULT', 24))
+POR_PAGINA_MAX = int(os.environ.get('POR_PAGINA_MAX', 100))
+
+def obtener_paginacion():
+    """Lee `pagina` y `por_pagina` de la query string, acotados a valores válidos"""
+    pagina = max(request.args.get('pagina', 1, type=int) or 1, 1)
+    por_pagina = request.args.get('por_pagina', POR_PAGINA_DEFAULT, type=int) or POR_PAGINA_DEFAULT
+    por_pagina = min(max(por_pagina, 1), POR_PAGINA_MAX)
+    return pagina, por_pagina
+
+def paginar(consulta, pagina, por_pagina):
+    """Devuelve (filas, hay_mas) pidiendo una fila extra en lugar de un COUNT"""
+    filas = consulta.limit(por_pagina + 1).offset((pagina - 1) * por_pagina).all()
+    return filas[:por_pagina], len(filas) > por_pagina
+
+def codificar_cursor(*valores):
+    """Codifica los valores de la última fila de una página como cursor opaco"""
+    datos = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in valores])
+    return base64.urlsafe_b64encode(datos.encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor):
+    """Decodifica un cursor generado por codificar_cursor (ValueError si es inválido)"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+CATALOGO_POR_PAGINA = int(os.environ.get('CATALOGO_POR_PAGINA', 24))
+
+def pagina_catalogo(categoria_id=None, cursor=None, por_pagina=CATALOGO_POR_PAGINA):
+    """Obtiene una página de productos activos para la tienda, ordenados por id.
+    
+    Devuelve (productos, siguiente_cursor); siguiente_cursor es None en la última página.
+    Lanza ValueError si el cursor es inválido.
+    """
+    consulta = Producto.query.options(joinedload(Producto.categoria)).filter(Producto.activo == True)
+    if categoria_id is not None:
+        consulta = consulta.filter(Producto.categoria_id == categoria_id)
+    if cursor:
+        ultimo_id, = decodificar_cursor(cursor)
+        consulta = consulta.filter(Producto.id > int(ultimo_id))
+    productos = consulta.order_by(Producto.id).limit(por_pagina + 1).all()
+    if len(productos) > por_pagina:
+        productos = productos[:por_pagina]
+        return productos, codificar_cursor(productos[-1].id)
+    return productos, None
 
+# Campos que el catálogo público puede proyectar con `fields=` y criterios de `orden=`
+CAMPOS_CATALOGO = ('id', 'nombre', 'descripcion', 'precio', 'imagen', 'stock', 'categoria_id')
+CAMPOS_CATALOGO_DEFAULT = ('id', 'nombre', 'descripcion', 'precio', 'imagen', 'stock')
+# Con cualquiera de estos parámetros /api/productos responde paginado
+PARAMETROS_CATALOGO_PAGINADO = ('pagina', 'por_pagina', 'cursor', 'fields', 'orden', 'categoria')
+ORDENES_CATALOGO = {
+    'id': Producto.id,
+    'nombre': Producto.nombre,
+    'precio': Producto.precio,
+}
+# Tipo JSON del valor de cada orden guardado en el cursor
+TIPOS_ORDEN_CATALOGO = {'id': int, 'nombre': str, 'precio': (int, float)}
 
 @app.route('/api/productos', methods=['GET'])
 def get_productos():
-    productos = Producto.query.filter_by(activo=True).all()
-    return jsonify([{
-        'id': p.id,
-        'nombre': p.nombre,
-        'descripcion': p.descripcion,
-        'precio': p.precio,
-        'imagen': p.imagen,
-        'stock': p.stock
-    } for p in productos])
+    """Catálogo de productos activos paginado por cursor.
+    
+    Parámetros opcionales: `categoria` (id), `orden` (id, nombre o precio; con `-`
+    delante es descendente), `fields` (columnas separadas por coma), `por_pagina`,
+    `cursor` (el `siguiente_cursor` de la respuesta anterior) o `pagina`.
+    Solo se consultan las columnas pedidas, sin construir objetos del ORM.
+    
+    Sin ninguno de esos parámetros se mantiene la respuesta original: la lista
+    completa como arreglo JSON, que es lo que esperan los clientes existentes.
+    """
+    try:
+        if not any(parametro in request.args for parametro in PARAMETROS_CATALOGO_PAGINADO):
+            filas = db.session.execute(
+                db.select(*[getattr(Producto, c) for c in CAMPOS_CATALOGO_DEFAULT])
+                .where(Producto.activo == True)
+                .order_by(Producto.id)
+            ).mappings().all()
+            return jsonify([dict(fila) for fila in filas])
+    
+        pagina, por_pagina = obtener_paginacion()
+    
+        campos = [c.strip() for c in request.args.get('fields', '').split(',') if c.strip()] or list(CAMPOS_CATALOGO_DEFAULT)
+        invalidos = [c for c in campos if c not in CAMPOS_CATALOGO]
+        if invalidos:
+            return jsonify({
+                'success': False,
+                'error': f'Campos no válidos: {", ".join(invalidos)}'
+            }), 400
+    
+        orden = request.args.get('orden', 'id')
+        descendente = orden.startswith('-')
+        columna_orden = ORDENES_CATALOGO.get(orden.lstrip('-'))
+        if columna_orden is None:
+            return jsonify({
+                'success': False,
+                'error': f'Orden no válido. Use: {", ".join(ORDENES_CATALOGO)}'
+            }), 400
+    
+        # La columna de orden y el id se seleccionan siempre para poder armar el cursor
+        columnas = list(dict.fromkeys(campos + [columna_orden.key, 'id']))
+        consulta = db.select(*[getattr(Producto, c) for c in columnas]).where(Producto.activo == True)
+    
+        categoria_id = request.args.get('categoria', type=int)
+        if categoria_id is not None:
+            consulta = consulta.where(Producto.categoria_id == categoria_id)
+    
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                # El cursor guarda el orden con el que se generó: con otro orden
+                # compararía la columna contra un valor de otro tipo
+                orden_cursor, valor, ultimo_id = decodificar_cursor(cursor)
+                if orden_cursor != orden or not isinstance(ultimo_id, int) or \
+                        not isinstance(valor, TIPOS_ORDEN_CATALOGO[columna_orden.key]) or isinstance(valor, bool):
+                    raise ValueError('Cursor inválido')
+            except (TypeError, ValueError):
+                return jsonify({
+                    'success': False,
+                    'error': 'Cursor inválido para este orden'
+                }), 400
+            clave = tuple_(columna_orden, Producto.id)
+            consulta = consulta.where(clave < (valor, ultimo_id) if descendente else clave > (valor, ultimo_id))
+        else:
+            consulta = consulta.offset((pagina - 1) * por_pagina)
+    
+        if descendente:
+            consulta = consulta.order_by(columna_orden.desc(), Producto.id.desc())
+        else:
+            consulta = consulta.order_by(columna_orden, Producto.id)
+    
+        filas = db.session.execute(consulta.limit(por_pagina + 1)).mappings().all()
+        hay_mas = len(filas) > por_pagina
+        filas = filas[:por_pagina]
+    
+        return jsonify({
+            'success': True,
+            'productos': [{campo: fila[campo] for campo in campos} for fila in filas],
+            'siguiente_cursor': codificar_cursor(orden, filas[-1][columna_orden.key], filas[-1]['id']) if hay_mas else None,
+            'hay_mas': hay_mas
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
 
 @app.route('/api/producto/<int:producto_id>', methods=['GET'])
 def get_producto(producto_id):
@@ -584,50 +1884,309 @@ def get_producto(producto_id):
         }
     })
 
+# ===== BÚSQUEDA DE PRODUCTOS =====
+
+BUSQUEDA_BACKEND = os.environ.get('BUSQUEDA_BACKEND', 'memoria')
+# El índice en memoria se reconstruye completo cada BUSQUEDA_TTL segundos para
+# recoger cambios hechos por otros procesos (otro worker, comandos CLI)
+BUSQUEDA_TTL = int(os.environ.get('BUSQUEDA_TTL', 600))
+BUSQUEDA_LIMITE_DEFAULT = 10
+BUSQUEDA_LIMITE_MAX = 50
+
+PALABRAS_VACIAS = frozenset({
+    'a', 'al', 'con', 'de', 'del', 'el', 'en', 'la', 'las', 'lo', 'los',
+    'o', 'para', 'por', 'sin', 'un', 'una', 'unos', 'unas', 'y'
+})
+
+def normalizar_texto(texto):
+    """Devuelve las palabras del texto en minúsculas, sin acentos y sin palabras vacías"""
+    texto = unicodedata.normalize('NFKD', (texto or '').casefold())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return [palabra for palabra in re.findall(r'\w+', texto) if palabra not in PALABRAS_VACIAS]
+
+class IndiceBusquedaMemoria:
+    """Índice invertido por proceso sobre nombre, categoría y descripción de los productos activos.
+    
+    Cada palabra apunta a {producto_id: peso}; el peso suma 3 si aparece en el nombre,
+    2 en la categoría y 1 en la descripción. Las palabras se guardan también en una
+    lista ordenada para resolver prefijos con bisect (autocompletado).
+    """
+    
+    PESOS = (('nombre', 3), ('categoria', 2), ('descripcion', 1))
+    
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._indice = {}  # palabra -> {producto_id: peso}
+        self._palabras_producto = {}  # producto_id -> palabras indexadas
+        self._vocabulario = []  # palabras ordenadas
+        self._construido = None
+        self._lock = threading.Lock()
+        # Serializa reconstrucciones y actualizaciones (que leen de la base de datos)
+        self._lock_escritura = threading.Lock()
+    
+    @staticmethod
+    def _consultar(ids=None):
+        consulta = db.session.query(
+            Producto.id, Producto.nombre, Producto.descripcion, Categoria.nombre.label('categoria')
+        ).outerjoin(Categoria, Producto.categoria_id == Categoria.id).filter(Producto.activo == True)
+        if ids is not None:
+            consulta = consulta.filter(Producto.id.in_(ids))
+        return consulta.all()
+    
+    def _pesos_fila(self, fila):
+        pesos = {}
+        for campo, peso in self.PESOS:
+            for palabra in set(normalizar_texto(getattr(fila, campo))):
+                pesos[palabra] = pesos.get(palabra, 0) + peso
+        return pesos
+    
+    def _quitar(self, producto_id):
+        for palabra in self._palabras_producto.pop(producto_id, ()):
+            productos = self._indice.get(palabra)
+            if productos is not None:
+                productos.pop(producto_id, None)
+                if not productos:
+                    del self._indice[palabra]
+                    del self._vocabulario[bisect.bisect_left(self._vocabulario, palabra)]
+    
+    def _agregar(self, producto_id, pesos):
+        for palabra, peso in pesos.items():
+            if palabra not in self._indice:
+                self._indice[palabra] = {}
+                bisect.insort(self._vocabulario, palabra)
+            self._indice[palabra][producto_id] = peso
+        self._palabras_producto[producto_id] = set(pesos)
+    
+    def reconstruir(self):
+        """Construye el índice completo con una sola consulta"""
+        with self._lock_escritura:
+            indice, palabras_producto = {}, {}
+            for fila in self._consultar():
+                pesos = self._pesos_fila(fila)
+                for palabra, peso in pesos.items():
+                    indice.setdefault(palabra, {})[fila.id] = peso
+                palabras_producto[fila.id] = set(pesos)
+            with self._lock:
+                self._indice = indice
+                self._palabras_producto = palabras_producto
+                self._vocabulario = sorted(indice)
+                self._construido = time.monotonic()
+    
+    def _asegurar_vigente(self):
+        construido = self._construido
+        if construido is None or time.monotonic() - construido > self.ttl:
+            self.reconstruir()
+    
+    def actualizar(self, ids):
+        """Reindexa los productos indicados tras un commit; los inactivos o borrados se quitan"""
+        ids = set(ids)
+        if not ids:
+            return
+        try:
+            with self._lock_escritura:
+                if self._construido is None:
+                    return  # Se construirá completo en la próxima búsqueda
+                filas = {fila.id: fila for fila in self._consultar(ids)}
+                with self._lock:
+                    for producto_id in ids:
+                        self._quitar(producto_id)
+                        if producto_id in filas:
+                            self._agregar(producto_id, self._pesos_fila(filas[producto_id]))
+        except Exception as e:
+            # Un índice a medio actualizar se descarta y se reconstruye en la próxima búsqueda
+            print(f"Error al actualizar el índice de búsqueda: {e}")
+            self.invalidar()
+    
+    def invalidar(self):
+        """Fuerza la reconstrucción completa en la próxima búsqueda"""
+        with self._lock_escritura:
+            self._construido = None
+    
+    def _coincidencias(self, palabra):
+        """Productos que contienen la palabra o una que empieza por ella, con su puntaje"""
+        puntajes = {}
+        inicio = bisect.bisect_left(self._vocabulario, palabra)
+        for candidata in itertools.islice(self._vocabulario, inicio, None):
+            if not candidata.startswith(palabra):
+                break
+            # Una coincidencia exacta vale el doble que una por prefijo
+            factor = 2 if candidata == palabra else 1
+            for producto_id, peso in self._indice[candidata].items():
+                puntajes[producto_id] = max(puntajes.get(producto_id, 0), peso * factor)
+        return puntajes
+    
+    def buscar(self, texto, limite=BUSQUEDA_LIMITE_DEFAULT):
+        """Devuelve los ids de los productos que contienen todas las palabras, por relevancia"""
+        palabras = normalizar_texto(texto)
+        if not palabras:
+            return []
+        self._asegurar_vigente()
+        with self._lock:
+            total = None
+            for palabra in dict.fromkeys(palabras):
+                puntajes = self._coincidencias(palabra)
+                if total is None:
+                    total = puntajes
+                else:
+                    total = {pid: total[pid] + puntaje for pid, puntaje in puntajes.items() if pid in total}
+                if not total:
+                    return []
+        return heapq.nsmallest(limite, total, key=lambda pid: (-total[pid], pid))
+
+class BusquedaPostgreSQL:
+    """Búsqueda de texto completo de PostgreSQL, compartida por todos los workers.
+    
+    Usa el índice GIN ix_producto_busqueda y la función f_unaccent que crea la
+    migración 0003. Una consulta coincide si todas sus palabras aparecen en el
+    producto (nombre y descripción) o en el nombre de su categoría.
+    """
+    
+    DOCUMENTO_PRODUCTO = (
+        "setweight(to_tsvector('spanish', f_unaccent(coalesce(producto.nombre, ''))), 'A') || "
+        "setweight(to_tsvector('spanish', f_unaccent(coalesce(producto.descripcion, ''))), 'C')"
+    )
+    DOCUMENTO_CATEGORIA = "setweight(to_tsvector('spanish', f_unaccent(coalesce(categoria.nombre, ''))), 'B')"
+    
+    def buscar(self, texto, limite=BUSQUEDA_LIMITE_DEFAULT):
+        palabras = normalizar_texto(texto)
+        if not palabras:
+            return []
+        consulta = db.text(f"""
+            SELECT producto.id
+            FROM producto LEFT JOIN categoria ON categoria.id = producto.categoria_id,
+                 to_tsquery('spanish', :consulta) AS q
+            WHERE producto.activo
+              AND ({self.DOCUMENTO_PRODUCTO} @@ q
+                   OR producto.categoria_id IN (
+                       SELECT categoria.id FROM categoria WHERE {self.DOCUMENTO_CATEGORIA} @@ q))
+            ORDER BY ts_rank({self.DOCUMENTO_PRODUCTO} || {self.DOCUMENTO_CATEGORIA}, q) DESC, producto.id
+            LIMIT :limite
+        """)
+        parametros = {'consulta': ' & '.join(f'{palabra}:*' for palabra in palabras), 'limite': limite}
+        return [fila[0] for fila in db.session.execute(consulta, parametros)]
+    
+    # La base de datos siempre está al día: no hay nada que actualizar
+    def actualizar(self, ids):
+        pass
+    
+    def invalidar(self):
+        pass
+
+if BUSQUEDA_BACKEND == 'postgresql' and app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    indice_busqueda = BusquedaPostgreSQL()
+else:
+    indice_busqueda = IndiceBusquedaMemoria(ttl=BUSQUEDA_TTL)
+
+@app.route('/api/buscar', methods=['GET'])
+def buscar_productos():
+    """Busca productos activos por nombre, descripción y categoría.
+    
+    Ignora mayúsculas y acentos ("cafe" encuentra "Café") y acepta palabras
+    incompletas ("caf" encuentra "Café"), así que sirve para autocompletar.
+    Parámetros: `q` y `limite` (máximo BUSQUEDA_LIMITE_MAX).
+    """
+    texto = request.args.get('q', '').strip()
+    limite = request.args.get('limite', BUSQUEDA_LIMITE_DEFAULT, type=int) or BUSQUEDA_LIMITE_DEFAULT
+    limite = min(max(limite, 1), BUSQUEDA_LIMITE_MAX)
+    
+    ids = indice_busqueda.buscar(texto, limite)
+    filas = {}
+    if ids:
+        consulta = db.select(
+            *[getattr(Producto, c) for c in CAMPOS_CATALOGO_DEFAULT], Categoria.nombre.label('categoria_nombre')
+        ).outerjoin(Categoria, Producto.categoria_id == Categoria.id).where(
+            Producto.id.in_(ids), Producto.activo == True
+        )
+        filas = {fila['id']: dict(fila) for fila in db.session.execute(consulta).mappings()}
+    productos = [filas[producto_id] for producto_id in ids if producto_id in filas]
+    
+    return jsonify({
+        'success': True,
+        'productos': productos,
+        'total': len(productos)
+    })
+
+CARRITO_MAX_ITEMS = int(os.environ.get('CARRITO_MAX_ITEMS', 100))
+
+@app.route('/api/carrito/cotizar', methods=['POST'])
+def cotizar_carrito_api():
+    """Precio, stock y disponibilidad actuales de todo el carrito en una sola petición.
+    
+    Recibe {"items": [{"producto_id", "cantidad"}, ...]} y devuelve una línea por
+    producto y el total calculado en el servidor.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({
+            'success': False,
+            'error': 'El carrito está vacío'
+        }), 400
+    if len(items) > CARRITO_MAX_ITEMS:
+        return jsonify({
+            'success': False,
+            'error': f'El carrito no puede tener más de {CARRITO_MAX_ITEMS} productos'
+        }), 400
+    
+    try:
+        cotizacion = cotizar_carrito(items)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': str(e) if isinstance(e, ValueError) else 'Formato de carrito inválido'
+        }), 400
+    
+    return jsonify({'success': True, **cotizacion})
+
 @app.route('/api/pedido', methods=['POST'])
 def crear_pedido():
     try:
         data = request.json
         
+        # Descontar el stock de todo el carrito de forma atómica
+        productos, error = reservar_stock(data['items'])
+        if error:
+            db.session.rollback()
+            return jsonify({
+                'success': False,
+                'error': error
+            }), 400
+        
+        # El total se calcula con los precios actuales y las mismas reglas que
+        # cotizar_carrito; el que envía el cliente se ignora
+        total = sum(
+            subtotal_linea(productos[producto_id].precio, cantidad)
+            for producto_id, cantidad in agrupar_cantidades(data['items']).items()
+        )
+        
         # Crear el pedido
         pedido = Pedido(
             cliente_nombre=data['cliente_nombre'],
             cliente_telefono=data['cliente_telefono'],
             cliente_direccion=data.get('cliente_direccion', ''),
             cliente_comentarios=data.get('cliente_comentarios', ''),
-            total=data['total']
+            total=round(total, 2)
         )
         
         db.session.add(pedido)
         db.session.flush()  # Para obtener el ID del pedido
         
-        # Crear los items del pedido y disminuir stock
+        # Crear los items del pedido
+        items_pedido = []
         for item in data['items']:
-            producto = Producto.query.get(item['producto_id'])
+            producto = productos.get(int(item['producto_id']))
             if producto:
-                # Validar que hay suficiente stock
-                if producto.stock < item['cantidad']:
-                    db.session.rollback()
-                    return jsonify({
-                        'success': False,
-                        'error': f'No hay suficiente stock para {producto.nombre}. Stock disponible: {producto.stock}'
-                    }), 400
-                
-                # Disminuir el stock
-                producto.stock -= item['cantidad']
-                
-                # Crear el item del pedido
                 pedido_item = PedidoItem(
                     pedido_id=pedido.id,
-                    producto_id=item['producto_id'],
-                    cantidad=item['cantidad'],
+                    producto_id=producto.id,
+                    cantidad=int(item['cantidad']),
                     precio_unitario=producto.precio
                 )
                 db.session.add(pedido_item)
+                items_pedido.append((pedido_item, producto))
         
-        db.session.commit()
-        
-        # Crear mensaje para WhatsApp
+        # Crear mensaje para WhatsApp con los productos ya cargados (el stock
+        # en memoria ya refleja el descuento hecho por reservar_stock)
         mensaje = f"🛒 *NUEVO PEDIDO #{pedido.id}*\n\n"
         mensaje += f"👤 Cliente: {pedido.cliente_nombre}\n"
         mensaje += f"📞 Teléfono: {pedido.cliente_telefono}\n"
@@ -638,20 +2197,25 @@ def crear_pedido():
         
         mensaje += "\n📦 *Productos:*\n"
         
-        for item in pedido.items:
-            mensaje += f"• {item.producto.nombre} x{item.cantidad} - S/{item.precio_unitario * item.cantidad:.2f}\n"
-            mensaje += f"  📊 Stock restante: {item.producto.stock}\n"
+        for item, producto in items_pedido:
+            mensaje += f"• {producto.nombre} x{item.cantidad} - S/{item.precio_unitario * item.cantidad:.2f}\n"
+            mensaje += f"  📊 Stock restante: {producto.stock}\n"
         
         mensaje += f"\n💰 *Total: S/{pedido.total:.2f}*\n"
         mensaje += f"📅 Fecha: {pedido.fecha_pedido.strftime('%d/%m/%Y %I:%M %p')}\n"
         mensaje += f"⏰ Hora: {pedido.fecha_pedido.strftime('%I:%M %p')}"
         
-        # Enviar a WhatsApp
-        enviar_whatsapp(mensaje)
+        # Encolar el mensaje en la misma transacción que el pedido; el despachador
+        # lo envía en segundo plano
+        encolar_whatsapp(mensaje)
+        db.session.commit()
+        despachador_whatsapp.despertar()
+        notificar_cambio_pedidos('pedido_creado', pedido.id)
         
         return jsonify({
             'success': True,
             'pedido_id': pedido.id,
+            'total': pedido.total,
             'mensaje': 'Pedido creado exitosamente'
         })
         
@@ -666,10 +2230,75 @@ def crear_pedido():
 @login_required
 def get_pedido(pedido_id):
     try:
-        pedido = Pedido.query.get_or_404(pedido_id)
+        pedido = Pedido.query.options(*Pedido.opciones_carga()).filter_by(id=pedido_id).first_or_404()
+        return jsonify({
+            'success': True,
+            'pedido': pedido.to_dict()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/pedidos', methods=['GET'])
+@login_required
+def get_pedidos():
+    """Lista pedidos del más reciente al más antiguo con paginación por cursor.
+    
+    Filtros opcionales: `estado` (uno o varios separados por coma), `desde` y `hasta`
+    (fechas ISO, `hasta` inclusivo) y `telefono`. Con `include=items` se cargan los
+    items de cada pedido. `cursor` es el `siguiente_cursor` de la página anterior.
+    """
+    try:
+        _, por_pagina = obtener_paginacion()
+        consulta = Pedido.query
+        
+        estados = [e.strip() for e in request.args.get('estado', '').split(',') if e.strip()]
+        if estados:
+            consulta = consulta.filter(Pedido.estado.in_(estados))
+        
+        telefono = request.args.get('telefono', '').strip()
+        if telefono:
+            consulta = consulta.filter(Pedido.cliente_telefono == telefono)
+        
+        try:
+            desde = request.args.get('desde')
+            if desde:
+                consulta = consulta.filter(Pedido.fecha_pedido >= datetime.fromisoformat(desde))
+            hasta = request.args.get('hasta')
+            if hasta:
+                limite = datetime.fromisoformat(hasta)
+                if len(hasta) == 10:  # Solo fecha: incluir el día completo
+                    consulta = consulta.filter(Pedido.fecha_pedido < limite + timedelta(days=1))
+                else:
+                    consulta = consulta.filter(Pedido.fecha_pedido <= limite)
+            
+            cursor = request.args.get('cursor')
+            if cursor:
+                fecha_cursor, id_cursor = decodificar_cursor(cursor)
+                consulta = consulta.filter(
+                    tuple_(Pedido.fecha_pedido, Pedido.id) < (datetime.fromisoformat(fecha_cursor), int(id_cursor))
+                )
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'error': 'Parámetros de fecha o cursor inválidos'
+            }), 400
+        
+        incluir_items = 'items' in request.args.get('include', '').split(',')
+        if incluir_items:
+            consulta = consulta.options(*Pedido.opciones_carga())
+        
+        pedidos = consulta.order_by(Pedido.fecha_pedido.desc(), Pedido.id.desc()).limit(por_pagina + 1).all()
+        hay_mas = len(pedidos) > por_pagina
+        pedidos = pedidos[:por_pagina]
+        
         return jsonify({
             'success': True,
-            'pedido': pedido.to_dict()
+            'pedidos': [pedido.to_dict(incluir_items=incluir_items) for pedido in pedidos],
+            'siguiente_cursor': codificar_cursor(pedidos[-1].fecha_pedido, pedidos[-1].id) if hay_mas else None,
+            'hay_mas': hay_mas
         })
     except Exception as e:
         return jsonify({
@@ -714,6 +2343,7 @@ def crear_producto():
         
         db.session.add(producto)
         db.session.commit()
+        indice_busqueda.actualizar([producto.id])
         
         return jsonify({
             'success': True,
@@ -734,6 +2364,7 @@ def editar_producto(producto_id):
     try:
         producto = Producto.query.get_or_404(producto_id)
         imagen_anterior = producto.imagen  # Guardar URL de imagen anterior
+        imagen_subida = False
         
         # Verificar si es una petición con archivo (multipart/form-data)
         if request.files:
@@ -744,11 +2375,8 @@ def editar_producto(producto_id):
                 nueva_imagen_url = subir_imagen_cloudinary(archivo, nombre_producto)
                 
                 if nueva_imagen_url:
-                    # Eliminar imagen anterior de Cloudinary si existe
-                    if imagen_anterior and 'cloudinary.com' in imagen_anterior:
-                        eliminar_imagen_cloudinary(imagen_anterior)
-                    
                     producto.imagen = nueva_imagen_url
+                    imagen_subida = True
             
             # Actualizar otros campos del formulario
             if request.form.get('nombre'):
@@ -784,6 +2412,12 @@ def editar_producto(producto_id):
                 producto.categoria_id = data.get('categoria_id') if data.get('categoria_id') else None
         
         db.session.commit()
+        indice_busqueda.actualizar([producto_id])
+        
+        # La imagen reemplazada se libera solo cuando el cambio ya está guardado. Si se
+        # volvió a subir la misma foto, la subida sumó una referencia que aquí se compensa
+        if imagen_anterior and (producto.imagen != imagen_anterior or imagen_subida):
+            eliminar_imagen_cloudinary(imagen_anterior)
         
         return jsonify({
             'success': True,
@@ -811,6 +2445,7 @@ def eliminar_producto(producto_id):
             # Si tiene pedidos, solo desactivar el producto
             producto.activo = False
             db.session.commit()
+            indice_busqueda.actualizar([producto_id])
             return jsonify({
                 'success': True,
                 'mensaje': 'Producto desactivado (tiene pedidos asociados)'
@@ -819,9 +2454,10 @@ def eliminar_producto(producto_id):
             # Si no tiene pedidos, eliminar completamente
             db.session.delete(producto)
             db.session.commit()
+            indice_busqueda.actualizar([producto_id])
             
-            # Eliminar imagen de Cloudinary si existe
-            if imagen_url and 'cloudinary.com' in imagen_url:
+            # Eliminar la imagen si está en nuestro almacenamiento
+            if imagen_url:
                 eliminar_imagen_cloudinary(imagen_url)
             
             return jsonify({
@@ -843,7 +2479,7 @@ def subir_imagen():
     try:
         print("🔧 DEBUG: Ruta /api/upload-image llamada")
         print(f"🔧 DEBUG: Archivos recibidos: {list(request.files.keys())}")
-        print(f"🔧 DEBUG: Cloudinary configurado: {bool(CLOUDINARY_CLOUD_NAME and CLOUDINARY_API_KEY and CLOUDINARY_API_SECRET)}")
+        print(f"🔧 DEBUG: Almacenamiento {almacenamiento.nombre} configurado: {almacenamiento.configurado()}")
         
         # Verificar que se haya enviado un archivo
         if 'imagen' not in request.files:
@@ -863,10 +2499,12 @@ def subir_imagen():
                 'error': 'No se ha seleccionado ningún archivo'
             }), 400
         
-        # Subir imagen a Cloudinary
-        url_imagen = subir_imagen_cloudinary(archivo, nombre_producto)
+        # Subir imagen a Cloudinary. La URL puede no llegar a guardarse, así que no suma
+        # referencia; si queda sin usar la elimina el barrido de imágenes huérfanas
+        url_imagen = subir_imagen_cloudinary(archivo, nombre_producto, referenciar=False)
         
         if url_imagen:
+            db.session.commit()
             return jsonify({
                 'success': True,
                 'url_imagen': url_imagen,
@@ -889,16 +2527,22 @@ def subir_imagen():
 @app.route('/api/categorias', methods=['GET'])
 def get_categorias():
     """Obtiene todas las categorías activas"""
-    categorias = Categoria.query.filter_by(activa=True).all()
-    return jsonify([categoria.to_dict() for categoria in categorias])
+    categorias = Categoria.with_counts(Categoria.activa == True)
+    return jsonify([
+        categoria.to_dict(total_productos=activos + inactivos)
+        for categoria, activos, inactivos in categorias
+    ])
 
 @app.route('/api/categoria/<int:categoria_id>', methods=['GET'])
 def get_categoria(categoria_id):
     """Obtiene una categoría específica"""
-    categoria = Categoria.query.get_or_404(categoria_id)
+    filas = Categoria.with_counts(Categoria.id == categoria_id)
+    if not filas:
+        abort(404)
+    categoria, activos, inactivos = filas[0]
     return jsonify({
         'success': True,
-        'categoria': categoria.to_dict()
+        'categoria': categoria.to_dict(total_productos=activos + inactivos)
     })
 
 @app.route('/api/categoria/<int:categoria_id>/productos', methods=['GET'])
@@ -906,14 +2550,15 @@ def get_categoria(categoria_id):
 def get_productos_categoria(categoria_id):
     """Obtiene información sobre los productos de una categoría"""
     try:
-        categoria = Categoria.query.get_or_404(categoria_id)
-        productos_activos = Producto.query.filter_by(categoria_id=categoria_id, activo=True).count()
-        productos_inactivos = Producto.query.filter_by(categoria_id=categoria_id, activo=False).count()
+        filas = Categoria.with_counts(Categoria.id == categoria_id)
+        if not filas:
+            abort(404)
+        categoria, productos_activos, productos_inactivos = filas[0]
         total_productos = productos_activos + productos_inactivos
         
         return jsonify({
             'success': True,
-            'categoria': categoria.to_dict(),
+            'categoria': categoria.to_dict(total_productos=total_productos),
             'estadisticas': {
                 'productos_activos': productos_activos,
                 'productos_inactivos': productos_inactivos,
@@ -963,7 +2608,7 @@ def crear_categoria():
         return jsonify({
             'success': True,
             'mensaje': 'Categoría creada exitosamente',
-            'categoria': categoria.to_dict()
+            'categoria': categoria.to_dict(total_productos=0)
         })
         
     except Exception as e:
@@ -1019,6 +2664,9 @@ def editar_categoria(categoria_id):
             categoria.activa = nueva_activa
         
         db.session.commit()
+        if 'nombre' in data or 'activa' in data:
+            # Cambia el texto indexado o la visibilidad de todos sus productos
+            indice_busqueda.invalidar()
         
         # Preparar mensaje de respuesta
         mensaje = 'Categoría actualizada exitosamente'
@@ -1051,7 +2699,7 @@ def eliminar_categoria(categoria_id):
         categoria = Categoria.query.get_or_404(categoria_id)
         
         # Verificar si tiene productos asociados
-        if categoria.productos:
+        if db.session.query(Producto.id).filter_by(categoria_id=categoria_id).first():
             return jsonify({
                 'success': False,
                 'error': 'No se puede eliminar la categoría porque tiene productos asociados'
@@ -1080,6 +2728,7 @@ def actualizar_estado_pedido(pedido_id):
         pedido = Pedido.query.get_or_404(pedido_id)
         pedido.estado = data['estado']
         db.session.commit()
+        notificar_cambio_pedidos('estado_actualizado', pedido_id)
         
         return jsonify({
             'success': True,
@@ -1097,13 +2746,13 @@ def actualizar_estado_pedido(pedido_id):
 @login_required
 def confirmar_pedido(pedido_id):
     try:
-        pedido = Pedido.query.get_or_404(pedido_id)
+        pedido = Pedido.query.options(*Pedido.opciones_carga()).filter_by(id=pedido_id).first_or_404()
         
         # Actualizar estado del pedido a confirmado
         pedido.estado = 'confirmado'
-        db.session.commit()
         
-        # Crear mensaje de confirmación para el cliente
+        # Crear mensaje de confirmación para el cliente (antes del commit, que expira
+        # los items ya cargados)
         mensaje_cliente = f"✅ *PEDIDO CONFIRMADO #{pedido.id}*\n\n"
         mensaje_cliente += f"¡Hola {pedido.cliente_nombre}!\n\n"
         mensaje_cliente += f"Tu pedido ha sido *confirmado* y está siendo preparado.\n\n"
@@ -1123,8 +2772,11 @@ def confirmar_pedido(pedido_id):
         mensaje_cliente += f"⏰ *Tiempo estimado:* 30-45 minutos\n\n"
         mensaje_cliente += f"¡Gracias por elegirnos! Te contactaremos cuando esté listo para entrega. 😊"
         
-        # Enviar mensaje al cliente
-        enviar_whatsapp_cliente(pedido.cliente_telefono, mensaje_cliente)
+        # Encolar el mensaje al cliente en la misma transacción que el cambio de estado
+        encolar_whatsapp(mensaje_cliente, destinatario=pedido.cliente_telefono)
+        db.session.commit()
+        despachador_whatsapp.despertar()
+        notificar_cambio_pedidos('estado_actualizado', pedido_id)
         
         return jsonify({
             'success': True,
@@ -1138,37 +2790,109 @@ def confirmar_pedido(pedido_id):
             'error': str(e)
         }), 500
 
+def resumen_notificaciones_pedidos():
+    """Contadores de pedidos por atender y datos del último pedido"""
+    contadores = ContadorPedido.obtener()
+    pedidos_pendientes = contadores.get('pendiente', 0)
+    pedidos_confirmados = contadores.get('confirmado', 0)
+    total_pendientes = pedidos_pendientes + pedidos_confirmados
+    
+    # Obtener el último pedido para mostrar información adicional
+    ultimo_pedido = Pedido.query.order_by(Pedido.fecha_pedido.desc()).first()
+    
+    return {
+        'pedidos_pendientes': pedidos_pendientes,
+        'pedidos_confirmados': pedidos_confirmados,
+        'total_pendientes': total_pendientes,
+        'ultimo_pedido': {
+            'id': ultimo_pedido.id,
+            'cliente_nombre': ultimo_pedido.cliente_nombre,
+            'total': ultimo_pedido.total,
+            'fecha_pedido': ultimo_pedido.fecha_pedido.isoformat() if ultimo_pedido.fecha_pedido else None,
+            'estado': ultimo_pedido.estado
+        } if ultimo_pedido else None
+    }
+
+def notificar_cambio_pedidos(evento, pedido_id):
+    """Publica el resumen actualizado a los administradores conectados por SSE.
+    
+    Se llama después del commit. Si nadie está suscrito no se consulta la base de datos.
+    """
+    if not canal_pedidos.tiene_suscriptores():
+        return
+    try:
+        datos = resumen_notificaciones_pedidos()
+        datos.update({'success': True, 'evento': evento, 'pedido_id': pedido_id})
+        canal_pedidos.publicar(datos)
+    except Exception as e:
+        print(f"Error al publicar notificación de pedidos: {e}")
+
 @app.route('/api/notificaciones/pedidos', methods=['GET'])
 @login_required
 def get_notificaciones_pedidos():
     """Obtiene el contador de pedidos pendientes para notificaciones"""
     try:
-        pedidos_pendientes = Pedido.query.filter_by(estado='pendiente').count()
-        pedidos_confirmados = Pedido.query.filter_by(estado='confirmado').count()
-        total_pendientes = pedidos_pendientes + pedidos_confirmados
-        
-        # Obtener el último pedido para mostrar información adicional
-        ultimo_pedido = Pedido.query.order_by(Pedido.fecha_pedido.desc()).first()
-        
-        return jsonify({
-            'success': True,
-            'pedidos_pendientes': pedidos_pendientes,
-            'pedidos_confirmados': pedidos_confirmados,
-            'total_pendientes': total_pendientes,
-            'ultimo_pedido': {
-                'id': ultimo_pedido.id if ultimo_pedido else None,
-                'cliente_nombre': ultimo_pedido.cliente_nombre if ultimo_pedido else None,
-                'total': ultimo_pedido.total if ultimo_pedido else None,
-                'fecha_pedido': ultimo_pedido.fecha_pedido.isoformat() if ultimo_pedido and ultimo_pedido.fecha_pedido else None,
-                'estado': ultimo_pedido.estado if ultimo_pedido else None
-            } if ultimo_pedido else None
-        })
+        datos = resumen_notificaciones_pedidos()
+        datos['success'] = True
+        return jsonify(datos)
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+# Un stream abierto ocupa un hilo del servidor; se cierra periódicamente y el
+# navegador (EventSource) se reconecta solo
+SSE_KEEPALIVE = int(os.environ.get('SSE_KEEPALIVE', 15))
+SSE_DURACION_MAX = int(os.environ.get('SSE_DURACION_MAX', 300))
+
+@app.route('/api/notificaciones/pedidos/stream', methods=['GET'])
+@login_required
+def stream_notificaciones_pedidos():
+    """Server-Sent Events con el resumen de pedidos cada vez que uno cambia.
+    
+    Al conectar se envía el estado actual; después, solo los cambios publicados en
+    canal_pedidos. Mientras no hay cambios no se consulta la base de datos.
+    Si ya hay SSE_MAX_STREAMS abiertos responde 503 y el panel usa el polling.
+    """
+    cola = canal_pedidos.suscribir()
+    if cola is None:
+        return jsonify({
+            'success': False,
+            'error': 'Demasiadas conexiones de notificaciones abiertas; use /api/notificaciones/pedidos'
+        }), 503
+    try:
+        inicial = resumen_notificaciones_pedidos()
+        inicial.update({'success': True, 'evento': 'inicial', 'pedido_id': None})
+    except Exception:
+        canal_pedidos.desuscribir(cola)
+        raise
+    # Liberar la conexión a la base de datos antes de empezar a transmitir
+    db.session.remove()
+    
+    def generar():
+        try:
+            yield 'retry: 3000\n\n'
+            yield f"event: pedidos\ndata: {json.dumps(inicial)}\n\n"
+            limite = time.monotonic() + SSE_DURACION_MAX
+            while time.monotonic() < limite:
+                try:
+                    datos = cola.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: pedidos\ndata: {json.dumps(datos)}\n\n"
+        finally:
+            canal_pedidos.desuscribir(cola)
+    
+    respuesta = Response(generar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Liberar el cupo aunque el cliente se desconecte antes de empezar a leer
+    respuesta.call_on_close(lambda: canal_pedidos.desuscribir(cola))
+    return respuesta
+
 @app.route('/api/pedido/<int:pedido_id>', methods=['DELETE'])
 @login_required
 def eliminar_pedido(pedido_id):
@@ -1182,6 +2906,7 @@ def eliminar_pedido(pedido_id):
         # Eliminar el pedido
         db.session.delete(pedido)
         db.session.commit()
+        notificar_cambio_pedidos('pedido_eliminado', pedido_id)
         
         return jsonify({
             'success': True,
@@ -1200,13 +2925,22 @@ def eliminar_pedido(pedido_id):
 def get_configuracion():
     """Obtiene la configuración actual de la tienda"""
     try:
-        nombre_tienda = Configuracion.get_valor('nombre_tienda', 'Mi Tienda Online')
-        descripcion_tienda = Configuracion.get_valor('descripcion_tienda', '')
-        whatsapp_admin = Configuracion.get_valor('whatsapp_admin', '')
-        logo_url = Configuracion.get_valor('logo_url', '')
-        banner_url = Configuracion.get_valor('banner_url', '')
-        banner_text = Configuracion.get_valor('banner_text', '')
-        banner_activo = Configuracion.get_valor('banner_activo', 'false')
+        valores = Configuracion.get_many({
+            'nombre_tienda': 'Mi Tienda Online',
+            'descripcion_tienda': '',
+            'whatsapp_admin': '',
+            'logo_url': '',
+            'banner_url': '',
+            'banner_text': '',
+            'banner_activo': 'false'
+        })
+        nombre_tienda = valores['nombre_tienda']
+        descripcion_tienda = valores['descripcion_tienda']
+        whatsapp_admin = valores['whatsapp_admin']
+        logo_url = valores['logo_url']
+        banner_url = valores['banner_url']
+        banner_text = valores['banner_text']
+        banner_activo = valores['banner_activo']
         
         # Obtener fecha de última actualización
         config_nombre = Configuracion.query.filter_by(clave='nombre_tienda').first()
@@ -1251,12 +2985,14 @@ def update_configuracion():
             }), 400
         
         # Guardar configuración
-        Configuracion.set_valor('nombre_tienda', nombre_tienda, 'Nombre de la tienda que aparece en el encabezado')
-        Configuracion.set_valor('descripcion_tienda', descripcion_tienda, 'Descripción de la tienda que aparece en la página principal')
-        Configuracion.set_valor('whatsapp_admin', whatsapp_admin, 'Número de WhatsApp del administrador para contacto')
-        Configuracion.set_valor('logo_url', logo_url, 'URL del logo de la tienda')
-        Configuracion.set_valor('banner_text', banner_text, 'Texto del banner de anuncio')
-        Configuracion.set_valor('banner_activo', str(banner_activo).lower(), 'Estado del banner (activo/inactivo)')
+        Configuracion.set_many({
+            'nombre_tienda': nombre_tienda,
+            'descripcion_tienda': descripcion_tienda,
+            'whatsapp_admin': whatsapp_admin,
+            'logo_url': logo_url,
+            'banner_text': banner_text,
+            'banner_activo': str(banner_activo).lower()
+        }, DESCRIPCIONES_CONFIGURACION)
         
         # Obtener fecha de actualización
         config_nombre = Configuracion.query.filter_by(clave='nombre_tienda').first()
@@ -1269,6 +3005,7 @@ def update_configuracion():
         })
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1306,7 +3043,7 @@ def subir_logo():
         logo_anterior = Configuracion.get_valor('logo_url', '')
         
         # Actualizar la configuración con la nueva URL
-        Configuracion.set_valor('logo_url', url_logo, 'URL del logo de la tienda')
+        Configuracion.set_many({'logo_url': url_logo}, DESCRIPCIONES_CONFIGURACION)
         
         # Eliminar el logo anterior de Cloudinary si existe
         if logo_anterior:
@@ -1356,7 +3093,7 @@ def subir_banner():
         banner_anterior = Configuracion.get_valor('banner_url', '')
         
         # Actualizar la configuración con la nueva URL
-        Configuracion.set_valor('banner_url', url_banner, 'URL del banner de anuncio')
+        Configuracion.set_many({'banner_url': url_banner}, DESCRIPCIONES_CONFIGURACION)
         
         # Eliminar el banner anterior de Cloudinary si existe
         if banner_anterior:
@@ -1383,12 +3120,14 @@ def eliminar_banner():
         banner_url = Configuracion.get_valor('banner_url', '')
         
         if banner_url:
-            # Eliminar de Cloudinary
-            eliminar_imagen_cloudinary(banner_url)
-            
             # Eliminar de la configuración
-            Configuracion.set_valor('banner_url', '', 'URL del banner de anuncio')
-            Configuracion.set_valor('banner_activo', 'false', 'Estado del banner (activo/inactivo)')
+            Configuracion.set_many({
+                'banner_url': '',
+                'banner_activo': 'false'
+            }, DESCRIPCIONES_CONFIGURACION)
+            
+            # Liberar la imagen cuando la configuración ya no la usa
+            eliminar_imagen_cloudinary(banner_url)
         
         return jsonify({
             'success': True,
@@ -1405,24 +3144,21 @@ def eliminar_banner():
 def get_configuracion_publica():
     """Obtiene la configuración pública de la tienda (sin login)"""
     try:
-        nombre_tienda = Configuracion.get_valor('nombre_tienda', 'Mi Tienda Online')
-        descripcion_tienda = Configuracion.get_valor('descripcion_tienda', '')
-        whatsapp_admin = Configuracion.get_valor('whatsapp_admin', '')
-        logo_url = Configuracion.get_valor('logo_url', '')
+        # Obtener toda la configuración pública en una sola consulta (o desde caché)
+        valores = Configuracion.get_many({
+            'nombre_tienda': 'Mi Tienda Online',
+            'descripcion_tienda': '',
+            'whatsapp_admin': '',
+            'logo_url': '',
+            **COLORES_DEFAULT
+        })
+        nombre_tienda = valores['nombre_tienda']
+        descripcion_tienda = valores['descripcion_tienda']
+        whatsapp_admin = valores['whatsapp_admin']
+        logo_url = valores['logo_url']
         
         # Obtener colores de la tienda
-        colores = {
-            'color_primario': Configuracion.get_valor('color_primario', '#007bff'),
-            'color_secundario': Configuracion.get_valor('color_secundario', '#6c757d'),
-            'color_exito': Configuracion.get_valor('color_exito', '#28a745'),
-            'color_peligro': Configuracion.get_valor('color_peligro', '#dc3545'),
-            'color_advertencia': Configuracion.get_valor('color_advertencia', '#ffc107'),
-            'color_info': Configuracion.get_valor('color_info', '#17a2b8'),
-            'color_fondo': Configuracion.get_valor('color_fondo', '#ffffff'),
-            'color_texto': Configuracion.get_valor('color_texto', '#333333'),
-            'color_fondo_secundario': Configuracion.get_valor('color_fondo_secundario', '#f8f9fa'),
-            'color_borde': Configuracion.get_valor('color_borde', '#dee2e6')
-        }
+        colores = {clave: valores[clave] for clave in COLORES_DEFAULT}
         
         # Obtener banners activos ordenados
         banners = Banner.query.filter_by(activo=True).order_by(Banner.orden.asc()).all()
@@ -1571,27 +3307,8 @@ def eliminar_banner_multiple(banner_id):
 def verificar_imagenes_productos():
     """Verifica el estado de las imágenes de los productos"""
     try:
-        productos = Producto.query.all()
-        resultados = []
-        
-        for producto in productos:
-            if producto.imagen:
-                existe = verificar_imagen_cloudinary(producto.imagen)
-                resultados.append({
-                    'id': producto.id,
-                    'nombre': producto.nombre,
-                    'imagen_url': producto.imagen,
-                    'existe': existe,
-                    'status': 'OK' if existe else 'ERROR'
-                })
-            else:
-                resultados.append({
-                    'id': producto.id,
-                    'nombre': producto.nombre,
-                    'imagen_url': None,
-                    'existe': False,
-                    'status': 'SIN_IMAGEN'
-                })
+        incremental = request.args.get('incremental', 'true').lower() != 'false'
+        resultados = reporte_imagenes_productos(incremental=incremental)
         
         return jsonify({
             'success': True,
@@ -1603,23 +3320,90 @@ def verificar_imagenes_productos():
             'error': str(e)
         }), 500
 
+@app.route('/api/verificar-imagenes/trabajo', methods=['POST'])
+@login_required
+def iniciar_verificacion_imagenes():
+    """Inicia la verificación de imágenes como trabajo en segundo plano"""
+    try:
+        data = request.get_json(silent=True) or {}
+        incremental = bool(data.get('incremental', True))
+        trabajo = iniciar_trabajo('verificar_imagenes', trabajo_verificar_imagenes, incremental)
+        
+        return jsonify({
+            'success': True,
+            'trabajo': trabajo.to_dict()
+        }), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/trabajos/<int:trabajo_id>', methods=['GET'])
+@login_required
+def get_trabajo(trabajo_id):
+    """Obtiene el estado y progreso de un trabajo en segundo plano"""
+    trabajo = Trabajo.query.get_or_404(trabajo_id)
+    return jsonify({
+        'success': True,
+        'trabajo': trabajo.to_dict()
+    })
+
+@app.route('/api/trabajos/<int:trabajo_id>/cancelar', methods=['POST'])
+@login_required
+def cancelar_trabajo(trabajo_id):
+    """Solicita la cancelación de un trabajo; se detiene al terminar el lote en curso"""
+    try:
+        trabajo = Trabajo.query.get_or_404(trabajo_id)
+        if trabajo.estado in ('completado', 'error', 'cancelado'):
+            return jsonify({
+                'success': False,
+                'error': f'El trabajo ya finalizó (estado: {trabajo.estado})'
+            }), 400
+        
+        trabajo.cancelacion_solicitada = True
+        if trabajo.estado == 'pendiente':
+            trabajo.estado = 'cancelado'
+        db.session.commit()
+        
+        return jsonify({
+            'success': True,
+            'trabajo': trabajo.to_dict()
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/trabajos/<int:trabajo_id>/descarga', methods=['GET'])
+@login_required
+def descargar_trabajo(trabajo_id):
+    """Descarga el archivo generado por un trabajo completado"""
+    trabajo = Trabajo.query.get_or_404(trabajo_id)
+    if trabajo.estado != 'completado' or not trabajo.archivo or not os.path.exists(trabajo.archivo):
+        return jsonify({
+            'success': False,
+            'error': f'El trabajo no tiene un archivo disponible (se conservan {TRABAJOS_RETENCION_HORAS:g} horas)'
+        }), 404
+    
+    extension = os.path.splitext(trabajo.archivo)[1].lstrip('.')
+    mimetype = next((tipo for tipo, ext in FORMATOS_EXPORTACION.values() if ext == extension), 'application/octet-stream')
+    return send_file(
+        trabajo.archivo,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f'productos_exportados_{trabajo.fecha_creacion.strftime("%Y%m%d_%H%M%S")}.{extension}'
+    )
+
 @app.route('/api/configuracion/colores', methods=['GET'])
 @login_required
 def get_colores():
     """Obtiene los colores actuales de la tienda"""
     try:
-        colores = {
-            'color_primario': Configuracion.get_valor('color_primario', '#007bff'),
-            'color_secundario': Configuracion.get_valor('color_secundario', '#6c757d'),
-            'color_exito': Configuracion.get_valor('color_exito', '#28a745'),
-            'color_peligro': Configuracion.get_valor('color_peligro', '#dc3545'),
-            'color_advertencia': Configuracion.get_valor('color_advertencia', '#ffc107'),
-            'color_info': Configuracion.get_valor('color_info', '#17a2b8'),
-            'color_fondo': Configuracion.get_valor('color_fondo', '#ffffff'),
-            'color_texto': Configuracion.get_valor('color_texto', '#333333'),
-            'color_fondo_secundario': Configuracion.get_valor('color_fondo_secundario', '#f8f9fa'),
-            'color_borde': Configuracion.get_valor('color_borde', '#dee2e6')
-        }
+        colores = Configuracion.get_many(COLORES_DEFAULT)
         
         return jsonify({
             'success': True,
@@ -1637,22 +3421,20 @@ def update_colores():
     """Actualiza los colores de la tienda"""
     try:
         data = request.json
-        colores_actualizados = 0
-        
-        # Lista de colores válidos
-        colores_validos = [
-            'color_primario', 'color_secundario', 'color_exito', 'color_peligro',
-            'color_advertencia', 'color_info', 'color_fondo', 'color_texto',
-            'color_fondo_secundario', 'color_borde'
-        ]
+        colores = {}
         
-        for color_key in colores_validos:
+        # Solo se aceptan los colores conocidos de la tienda
+        for color_key in COLORES_DEFAULT:
             if color_key in data:
                 color_value = data[color_key].strip()
                 # Validar que sea un color hexadecimal válido
                 if color_value.startswith('#') and len(color_value) == 7:
-                    Configuracion.set_valor(color_key, color_value, f'Color {color_key.replace("_", " ").title()}')
-                    colores_actualizados += 1
+                    colores[color_key] = color_value
+        
+        # Guardar todos los colores en una sola transacción
+        colores_actualizados = Configuracion.set_many(colores, {
+            color_key: f'Color {color_key.replace("_", " ").title()}' for color_key in colores
+        })
         
         return jsonify({
             'success': True,
@@ -1660,6 +3442,7 @@ def update_colores():
             'colores_actualizados': colores_actualizados
         })
     except Exception as e:
+        db.session.rollback()
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1725,54 +3508,352 @@ def cambiar_password():
 
 # ===== RUTAS DE EXPORTAR/IMPORTAR PRODUCTOS =====
 
+# Formatos de exportación: tipo MIME y extensión del archivo
+FORMATOS_EXPORTACION = {
+    'txt': ('text/plain', 'txt'),
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson')
+}
+EXPORTACION_LOTE = int(os.environ.get('EXPORTACION_LOTE', 500))
+
+def iterar_productos_exportacion():
+    """Recorre los productos en lotes de EXPORTACION_LOTE filas sin cargarlos todos en memoria.
+    
+    Cada lote es una consulta independiente paginada por id, así que entre lotes se
+    puede hacer commit (progreso de trabajos) sin invalidar un cursor abierto.
+    """
+    categorias = dict(db.session.query(Categoria.id, Categoria.nombre).all())
+    ultimo_id = 0
+    while True:
+        lote = db.session.query(
+            Producto.id, Producto.nombre, Producto.descripcion, Producto.precio,
+            Producto.stock, Producto.categoria_id, Producto.activo, Producto.imagen
+        ).filter(Producto.id > ultimo_id).order_by(Producto.id).limit(EXPORTACION_LOTE).all()
+        if not lote:
+            break
+        for producto in lote:
+            yield producto, categorias.get(producto.categoria_id, 'Sin categoría')
+        ultimo_id = lote[-1].id
+
+def generar_exportacion_productos(formato='txt', al_avanzar=None):
+    """Genera el archivo de exportación por partes, un lote de productos a la vez.
+    
+    `al_avanzar(productos_exportados)` se llama después de cada lote.
+    """
+    exportados = 0
+    if formato == 'txt':
+        total = db.session.query(func.count(Producto.id)).scalar()
+        yield (
+            "=== EXPORTACIÓN DE PRODUCTOS ===\n"
+            f"Fecha de exportación: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n"
+            f"Total de productos: {total}\n"
+            "\n"
+            "FORMATO:\n"
+            "ID | NOMBRE | DESCRIPCIÓN | PRECIO | STOCK | CATEGORÍA | ACTIVO | IMAGEN_URL\n"
+            + "-" * 100 + "\n"
+            "\n"
+        )
+    elif formato == 'csv':
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(['id', 'nombre', 'descripcion', 'precio', 'stock', 'categoria', 'activo', 'imagen_url'])
+        yield buffer.getvalue()
+    
+    lote = []
+    for producto, categoria_nombre in iterar_productos_exportacion():
+        if formato == 'txt':
+            estado = "Sí" if producto.activo else "No"
+            imagen_url = producto.imagen or 'Sin imagen'
+            lote.append(f"{producto.id} | {producto.nombre} | {producto.descripcion or 'Sin descripción'} | {producto.precio} | {producto.stock} | {categoria_nombre} | {estado} | {imagen_url}\n")
+        elif formato == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow([
+                producto.id, producto.nombre, producto.descripcion or '', producto.precio, producto.stock,
+                categoria_nombre, "Sí" if producto.activo else "No", producto.imagen or ''
+            ])
+            lote.append(buffer.getvalue())
+        else:
+            lote.append(json.dumps({
+                'id': producto.id,
+                'nombre': producto.nombre,
+                'descripcion': producto.descripcion,
+                'precio': producto.precio,
+                'stock': producto.stock,
+                'categoria_id': producto.categoria_id,
+                'categoria_nombre': categoria_nombre,
+                'activo': producto.activo,
+                'imagen': producto.imagen
+            }, ensure_ascii=False) + "\n")
+        
+        if len(lote) >= EXPORTACION_LOTE:
+            yield ''.join(lote)
+            exportados += len(lote)
+            lote = []
+            if al_avanzar:
+                al_avanzar(exportados)
+    
+    if lote:
+        yield ''.join(lote)
+        exportados += len(lote)
+        if al_avanzar:
+            al_avanzar(exportados)
+    
+    if formato == 'txt':
+        yield "\n=== FIN DE EXPORTACIÓN ==="
+
 @app.route('/api/productos/exportar', methods=['GET'])
 @login_required
 def exportar_productos():
-    """Exporta todos los productos a un archivo de texto"""
+    """Exporta todos los productos como descarga en streaming (formato txt, csv o ndjson)"""
+    formato = request.args.get('formato', 'txt').lower()
+    if formato not in FORMATOS_EXPORTACION:
+        return jsonify({
+            'success': False,
+            'error': f'Formato no soportado. Use: {", ".join(FORMATOS_EXPORTACION)}'
+        }), 400
+    
+    mimetype, extension = FORMATOS_EXPORTACION[formato]
+    return Response(
+        stream_with_context(generar_exportacion_productos(formato)),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename=productos_exportados_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+        }
+    )
+
+def trabajo_exportar_productos(trabajo, formato):
+    """Trabajo en segundo plano que escribe la exportación en un archivo descargable"""
+    total = db.session.query(func.count(Producto.id)).scalar()
+    trabajo.actualizar_progreso(0, total)
+    
+    os.makedirs(DIRECTORIO_TRABAJOS, exist_ok=True)
+    _, extension = FORMATOS_EXPORTACION[formato]
+    ruta = os.path.join(DIRECTORIO_TRABAJOS, f'exportacion_{trabajo.id}.{extension}')
     try:
-        productos = Producto.query.all()
-        categorias = {cat.id: cat.nombre for cat in Categoria.query.all()}
-        
-        # Crear contenido del archivo
-        contenido = []
-        contenido.append("=== EXPORTACIÓN DE PRODUCTOS ===")
-        contenido.append(f"Fecha de exportación: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
-        contenido.append(f"Total de productos: {len(productos)}")
-        contenido.append("")
-        contenido.append("FORMATO:")
-        contenido.append("ID | NOMBRE | DESCRIPCIÓN | PRECIO | STOCK | CATEGORÍA | ACTIVO | IMAGEN_URL")
-        contenido.append("-" * 100)
-        contenido.append("")
-        
-        for producto in productos:
-            categoria_nombre = categorias.get(producto.categoria_id, 'Sin categoría')
-            estado = "Sí" if producto.activo else "No"
-            imagen_url = producto.imagen or 'Sin imagen'
-            contenido.append(f"{producto.id} | {producto.nombre} | {producto.descripcion or 'Sin descripción'} | {producto.precio} | {producto.stock} | {categoria_nombre} | {estado} | {imagen_url}")
-        
-        contenido.append("")
-        contenido.append("=== FIN DE EXPORTACIÓN ===")
-        
-        # Crear respuesta con el archivo
-        output = io.StringIO()
-        output.write('\n'.join(contenido))
-        output.seek(0)
-        
-        from flask import Response
-        return Response(
-            output.getvalue(),
-            mimetype='text/plain',
-            headers={
-                'Content-Disposition': f'attachment; filename=productos_exportados_{datetime.now().strftime("%Y%m%d_%H%M%S")}.txt'
-            }
-        )
+        with open(ruta, 'w', encoding='utf-8', newline='') as salida:
+            for parte in generar_exportacion_productos(formato, al_avanzar=trabajo.actualizar_progreso):
+                salida.write(parte)
+    except BaseException:
+        os.remove(ruta)
+        raise
+    
+    trabajo.archivo = ruta
+    return {
+        'productos_exportados': total,
+        'formato': formato,
+        'descarga': f'/api/trabajos/{trabajo.id}/descarga'
+    }
+
+@app.route('/api/productos/exportar/trabajo', methods=['POST'])
+@login_required
+def iniciar_exportacion_productos():
+    """Inicia la exportación de productos como trabajo en segundo plano (catálogos grandes)"""
+    try:
+        formato = request.args.get('formato', 'txt').lower()
+        if formato not in FORMATOS_EXPORTACION:
+            return jsonify({
+                'success': False,
+                'error': f'Formato no soportado. Use: {", ".join(FORMATOS_EXPORTACION)}'
+            }), 400
         
+        trabajo = iniciar_trabajo('exportar_productos', trabajo_exportar_productos, formato)
+        return jsonify({
+            'success': True,
+            'trabajo': trabajo.to_dict()
+        }), 202
     except Exception as e:
+        db.session.rollback()
         return jsonify({
             'success': False,
-            'error': f'Error al exportar productos: {str(e)}'
+            'error': str(e)
         }), 500
 
+IMPORTACION_LOTE = int(os.environ.get('IMPORTACION_LOTE', 500))
+
+def importar_productos_desde(lineas, tamano_lote=IMPORTACION_LOTE, al_avanzar=None):
+    """Importa productos desde un iterable de líneas en formato de exportación (separado por |).
+    
+    Los productos existentes se indexan por id y por nombre con una sola consulta; las
+    inserciones y actualizaciones se acumulan y se aplican en lotes de `tamano_lote`
+    con un commit por lote. `al_avanzar(lineas_procesadas, errores)` se llama tras cada lote.
+    Retorna el detalle de la importación con la lista de errores por línea.
+    """
+    # Obtener mapeo de categorías por nombre
+    categorias = {cat.nombre.lower(): cat.id for cat in Categoria.query.all()}
+    
+    # Índices de productos existentes (por id y por nombre)
+    ids_existentes = set()
+    ids_por_nombre = {}
+    for producto_id, nombre in db.session.query(Producto.id, Producto.nombre).order_by(Producto.id):
+        ids_existentes.add(producto_id)
+        ids_por_nombre.setdefault(nombre, producto_id)
+    
+    inserciones = {}  # nombre -> columnas del producto nuevo
+    actualizaciones = {}  # id -> columnas a actualizar
+    
+    productos_importados = 0
+    productos_actualizados = 0
+    categorias_creadas = 0
+    errores = []
+    lineas_procesadas = 0
+    
+    def aplicar_lote():
+        ids_lote = set(actualizaciones)
+        if inserciones:
+            filas = db.session.execute(
+                insert(Producto).returning(Producto.id, Producto.nombre),
+                list(inserciones.values())
+            )
+            for producto_id, nombre in filas:
+                ids_existentes.add(producto_id)
+                ids_por_nombre.setdefault(nombre, producto_id)
+                ids_lote.add(producto_id)
+            inserciones.clear()
+        if actualizaciones:
+            db.session.execute(update(Producto), list(actualizaciones.values()))
+            actualizaciones.clear()
+        db.session.commit()
+        indice_busqueda.actualizar(ids_lote)
+        if al_avanzar:
+            al_avanzar(lineas_procesadas, errores)
+    
+    # Procesar cada línea
+    for i, linea in enumerate(lineas, 1):
+        lineas_procesadas = i
+        linea = linea.strip()
+        
+        # Saltar líneas vacías, comentarios y encabezados
+        if not linea or linea.startswith('===') or linea.startswith('FORMATO:') or linea.startswith('-') or 'ID | NOMBRE' in linea:
+            continue
+        
+        # Dividir la línea por el separador |
+        partes = [parte.strip() for parte in linea.split('|')]
+        
+        # Verificar si es el formato nuevo (con imagen) o el formato anterior (sin imagen)
+        if len(partes) < 7:
+            errores.append(f"Línea {i}: Formato incorrecto (faltan campos)")
+            continue
+        
+        try:
+            # Extraer datos
+            id_producto = partes[0] if partes[0] else None
+            nombre = partes[1]
+            descripcion = partes[2] if partes[2] != 'Sin descripción' else ''
+            precio = float(partes[3])
+            stock = int(partes[4])
+            categoria_nombre = partes[5]
+            activo = partes[6].lower() in ['sí', 'si', 'yes', 'true', '1']
+            
+            # Procesar URL de imagen (puede estar en la posición 7 o no existir)
+            imagen_url = ''
+            if len(partes) >= 8:
+                imagen_url = partes[7] if partes[7] != 'Sin imagen' else ''
+            
+            # Validar datos obligatorios
+            if not nombre:
+                errores.append(f"Línea {i}: El nombre es obligatorio")
+                continue
+            
+            if precio < 0:
+                errores.append(f"Línea {i}: El precio no puede ser negativo")
+                continue
+            
+            if stock < 0:
+                errores.append(f"Línea {i}: El stock no puede ser negativo")
+                continue
+            
+            # Buscar o crear categoría
+            categoria_id = None
+            if categoria_nombre and categoria_nombre != 'Sin categoría':
+                categoria_id = categorias.get(categoria_nombre.lower())
+                if not categoria_id:
+                    # Crear nueva categoría automáticamente
+                    try:
+                        nueva_categoria = Categoria(
+                            nombre=categoria_nombre,
+                            descripcion=f'Categoría creada automáticamente al importar productos',
+                            icono='fas fa-tag',  # Icono por defecto
+                            color='#007bff'  # Color azul por defecto
+                        )
+                        db.session.add(nueva_categoria)
+                        db.session.flush()  # Para obtener el ID
+                        
+                        # Actualizar el mapeo de categorías
+                        categorias[categoria_nombre.lower()] = nueva_categoria.id
+                        categoria_id = nueva_categoria.id
+                        categorias_creadas += 1
+                        
+                    except Exception as e:
+                        errores.append(f"Línea {i}: Error al crear categoría '{categoria_nombre}': {str(e)}")
+                        continue
+            
+            datos = {
+                'descripcion': descripcion,
+                'precio': precio,
+                'stock': stock,
+                'categoria_id': categoria_id,
+                'activo': activo
+            }
+            # Solo actualizar la imagen si se proporciona una URL válida
+            if imagen_url:
+                datos['imagen'] = imagen_url
+            
+            # Verificar si el producto ya existe (por ID o nombre), incluyendo
+            # los productos nuevos del lote que aún no se han insertado
+            producto_id = None
+            if id_producto and id_producto.isdigit() and int(id_producto) in ids_existentes:
+                producto_id = int(id_producto)
+            if producto_id is None:
+                producto_id = ids_por_nombre.get(nombre)
+            
+            if producto_id is not None:
+                # Actualizar producto existente
+                actualizaciones.setdefault(producto_id, {'id': producto_id}).update(datos)
+                productos_actualizados += 1
+            elif nombre in inserciones:
+                # Producto repetido en el archivo antes de insertarse
+                inserciones[nombre].update(datos)
+                productos_actualizados += 1
+            else:
+                # Crear nuevo producto
+                inserciones[nombre] = {'nombre': nombre, 'imagen': '', **datos}
+                productos_importados += 1
+            
+        except ValueError as e:
+            errores.append(f"Línea {i}: Error en formato de datos - {str(e)}")
+            continue
+        except Exception as e:
+            errores.append(f"Línea {i}: Error inesperado - {str(e)}")
+            continue
+        
+        if len(inserciones) + len(actualizaciones) >= tamano_lote:
+            aplicar_lote()
+    
+    # Guardar el último lote
+    aplicar_lote()
+    
+    return {
+        'productos_importados': productos_importados,
+        'productos_actualizados': productos_actualizados,
+        'categorias_creadas': categorias_creadas,
+        'errores': len(errores),
+        'lista_errores': errores[:10]  # Solo mostrar los primeros 10 errores
+    }
+
+def trabajo_importar_productos(trabajo, ruta, tamano_lote):
+    """Trabajo en segundo plano que importa productos desde un archivo subido
+    (iniciar_trabajo elimina el archivo al terminar)"""
+    with open(ruta, encoding='utf-8') as entrada:
+        total = sum(1 for _ in entrada)
+    trabajo.actualizar_progreso(0, total)
+    
+    with open(ruta, encoding='utf-8') as entrada:
+        return importar_productos_desde(
+            entrada,
+            tamano_lote,
+            al_avanzar=lambda procesadas, errores: trabajo.actualizar_progreso(procesadas, errores=errores)
+        )
+
 @app.route('/api/productos/importar', methods=['POST'])
 @login_required
 def importar_productos():
@@ -1791,144 +3872,34 @@ def importar_productos():
                 'error': 'No se ha seleccionado ningún archivo'
             }), 400
         
-        # Leer el contenido del archivo
-        contenido = archivo.read().decode('utf-8')
-        lineas = contenido.split('\n')
+        tamano_lote = max(request.form.get('lote', IMPORTACION_LOTE, type=int), 1)
         
-        # Obtener mapeo de categorías por nombre
-        categorias = {cat.nombre.lower(): cat.id for cat in Categoria.query.all()}
-        
-        productos_importados = 0
-        productos_actualizados = 0
-        categorias_creadas = 0
-        errores = []
-        
-        # Procesar cada línea
-        for i, linea in enumerate(lineas, 1):
-            linea = linea.strip()
-            
-            # Saltar líneas vacías, comentarios y encabezados
-            if not linea or linea.startswith('===') or linea.startswith('FORMATO:') or linea.startswith('-') or 'ID | NOMBRE' in linea:
-                continue
+        # Modo síncrono: leer el archivo línea por línea dentro de la petición
+        if request.form.get('modo') == 'sincrono':
+            lineas = io.TextIOWrapper(archivo.stream, encoding='utf-8')
+            detalles = importar_productos_desde(lineas, tamano_lote)
             
-            # Dividir la línea por el separador |
-            partes = [parte.strip() for parte in linea.split('|')]
-            
-            # Verificar si es el formato nuevo (con imagen) o el formato anterior (sin imagen)
-            if len(partes) < 7:
-                errores.append(f"Línea {i}: Formato incorrecto (faltan campos)")
-                continue
-            
-            try:
-                # Extraer datos
-                id_producto = partes[0] if partes[0] else None
-                nombre = partes[1]
-                descripcion = partes[2] if partes[2] != 'Sin descripción' else ''
-                precio = float(partes[3])
-                stock = int(partes[4])
-                categoria_nombre = partes[5]
-                activo = partes[6].lower() in ['sí', 'si', 'yes', 'true', '1']
-                
-                # Procesar URL de imagen (puede estar en la posición 7 o no existir)
-                imagen_url = ''
-                if len(partes) >= 8:
-                    imagen_url = partes[7] if partes[7] != 'Sin imagen' else ''
-                elif len(partes) == 7:
-                    # Formato anterior sin imagen
-                    imagen_url = ''
-                
-                # Validar datos obligatorios
-                if not nombre:
-                    errores.append(f"Línea {i}: El nombre es obligatorio")
-                    continue
-                
-                if precio < 0:
-                    errores.append(f"Línea {i}: El precio no puede ser negativo")
-                    continue
-                
-                if stock < 0:
-                    errores.append(f"Línea {i}: El stock no puede ser negativo")
-                    continue
-                
-                # Buscar o crear categoría
-                categoria_id = None
-                if categoria_nombre and categoria_nombre != 'Sin categoría':
-                    categoria_id = categorias.get(categoria_nombre.lower())
-                    if not categoria_id:
-                        # Crear nueva categoría automáticamente
-                        try:
-                            nueva_categoria = Categoria(
-                                nombre=categoria_nombre,
-                                descripcion=f'Categoría creada automáticamente al importar productos',
-                                icono='fas fa-tag',  # Icono por defecto
-                                color='#007bff'  # Color azul por defecto
-                            )
-                            db.session.add(nueva_categoria)
-                            db.session.flush()  # Para obtener el ID
-                            
-                            # Actualizar el mapeo de categorías
-                            categorias[categoria_nombre.lower()] = nueva_categoria.id
-                            categoria_id = nueva_categoria.id
-                            categorias_creadas += 1
-                            
-                        except Exception as e:
-                            errores.append(f"Línea {i}: Error al crear categoría '{categoria_nombre}': {str(e)}")
-                            continue
-                
-                # Verificar si el producto ya existe (por ID o nombre)
-                producto_existente = None
-                if id_producto and id_producto.isdigit():
-                    producto_existente = Producto.query.get(int(id_producto))
-                
-                if not producto_existente:
-                    producto_existente = Producto.query.filter_by(nombre=nombre).first()
-                
-                if producto_existente:
-                    # Actualizar producto existente
-                    producto_existente.descripcion = descripcion
-                    producto_existente.precio = precio
-                    producto_existente.stock = stock
-                    producto_existente.categoria_id = categoria_id
-                    producto_existente.activo = activo
-                    # Solo actualizar la imagen si se proporciona una URL válida
-                    if imagen_url and imagen_url.strip():
-                        producto_existente.imagen = imagen_url.strip()
-                    productos_actualizados += 1
-                else:
-                    # Crear nuevo producto
-                    nuevo_producto = Producto(
-                        nombre=nombre,
-                        descripcion=descripcion,
-                        precio=precio,
-                        stock=stock,
-                        categoria_id=categoria_id,
-                        activo=activo,
-                        imagen=imagen_url.strip() if imagen_url and imagen_url.strip() else ''
-                    )
-                    db.session.add(nuevo_producto)
-                    productos_importados += 1
-                
-            except ValueError as e:
-                errores.append(f"Línea {i}: Error en formato de datos - {str(e)}")
-                continue
-            except Exception as e:
-                errores.append(f"Línea {i}: Error inesperado - {str(e)}")
-                continue
+            return jsonify({
+                'success': True,
+                'mensaje': f'Importación completada exitosamente',
+                'detalles': detalles
+            })
         
-        # Guardar cambios en la base de datos
-        db.session.commit()
+        # Guardar el archivo y procesarlo como trabajo en segundo plano
+        os.makedirs(DIRECTORIO_TRABAJOS, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=DIRECTORIO_TRABAJOS, prefix='importacion_', suffix='.txt', delete=False) as destino:
+            archivo.save(destino)
+        
+        trabajo = iniciar_trabajo(
+            'importar_productos', trabajo_importar_productos, destino.name, tamano_lote,
+            archivo_entrada=destino.name
+        )
         
         return jsonify({
             'success': True,
-            'mensaje': f'Importación completada exitosamente',
-            'detalles': {
-                'productos_importados': productos_importados,
-                'productos_actualizados': productos_actualizados,
-                'categorias_creadas': categorias_creadas,
-                'errores': len(errores),
-                'lista_errores': errores[:10]  # Solo mostrar los primeros 10 errores
-            }
-        })
+            'mensaje': 'Importación iniciada',
+            'trabajo': trabajo.to_dict()
+        }), 202
         
     except Exception as e:
         db.session.rollback()
@@ -1942,43 +3913,195 @@ def importar_productos():
 @app.route('/')
 def tienda_index():
     """Página principal de la tienda"""
-    productos = Producto.query.filter_by(activo=True).all()
-    categorias = Categoria.query.filter_by(activa=True).all()
-    return render_template('index.html', productos=productos, categorias=categorias)
+    return renderizar_inicio()
+
+@app.route('/productos/fragmento')
+def productos_fragmento():
+    """Fragmento HTML con la siguiente página de tarjetas de la tienda (scroll infinito).
+    
+    Acepta `categoria` y `cursor`; el cursor de la página siguiente se devuelve en la
+    cabecera X-Siguiente-Cursor (vacía cuando no hay más productos).
+    Con `q` devuelve los resultados de la búsqueda por relevancia, en una sola página.
+    """
+    texto = request.args.get('q', '').strip()
+    if texto:
+        ids = indice_busqueda.buscar(texto, BUSQUEDA_LIMITE_MAX)
+        encontrados = {
+            producto.id: producto
+            for producto in Producto.query.options(joinedload(Producto.categoria)).filter(
+                Producto.id.in_(ids), Producto.activo == True
+            )
+        } if ids else {}
+        productos = [encontrados[producto_id] for producto_id in ids if producto_id in encontrados]
+        respuesta = Response(render_template('_productos_fragmento.html', productos=productos))
+        respuesta.headers['X-Siguiente-Cursor'] = ''
+        return respuesta
+    try:
+        productos, siguiente_cursor = pagina_catalogo(
+            categoria_id=request.args.get('categoria', type=int),
+            cursor=request.args.get('cursor')
+        )
+    except (TypeError, ValueError):
+        return 'Cursor inválido', 400
+    respuesta = Response(render_template('_productos_fragmento.html', productos=productos))
+    respuesta.headers['X-Siguiente-Cursor'] = siguiente_cursor or ''
+    return respuesta
+
+def ancho_imagen(url):
+    """Ancho real de una imagen guardada por guardar_imagen, o None si no se conoce"""
+    coincidencia = ANCHO_EN_NOMBRE.search(url.split('?')[0]) if url else None
+    return int(coincidencia.group(1)) if coincidencia else None
+
+@app.template_filter('imagen_responsiva')
+def imagen_responsiva(url, sizes=SIZES_TARJETA_PRODUCTO):
+    """Atributos src, srcset, sizes y loading de un <img> para una imagen guardada.
+    
+    El srcset solo ofrece variantes más angostas que el original, cuyo ancho se toma
+    del nombre del archivo. Las URLs externas y las imágenes subidas sin el ancho en
+    el nombre se devuelven sin srcset.
+    
+        <img {{ producto.imagen|imagen_responsiva }} alt="...">
+    """
+    fuentes = []
+    ancho = ancho_imagen(url)
+    for ancho_variante in IMAGEN_ANCHOS_VARIANTES if ancho else ():
+        if ancho_variante >= ancho:
+            break
+        url_variante = almacenamiento.variante(url, ancho_variante)
+        if not url_variante:
+            break
+        fuentes.append(f'{url_variante} {ancho_variante}w')
+    
+    atributos = f'src="{escape(url)}"'
+    if fuentes:
+        fuentes.append(f'{url} {ancho}w')
+        atributos += f' srcset="{escape(", ".join(fuentes))}" sizes="{escape(sizes)}"'
+    return Markup(atributos + ' loading="lazy" decoding="async"')
+
+def generar_variante_local(ruta):
+    """Crea en disco la variante reducida `ruta` a partir de su original, si procede.
+    
+    Solo se generan los anchos de IMAGEN_ANCHOS_VARIANTES, para que no se puedan
+    pedir tamaños arbitrarios. Las siguientes peticiones leen el archivo ya creado.
+    """
+    original, ancho = almacenamiento.original_de_variante(ruta)
+    if not original or ancho not in IMAGEN_ANCHOS_VARIANTES:
+        return
+    ruta_original = safe_join(almacenamiento.directorio, original)
+    destino = safe_join(almacenamiento.directorio, ruta)
+    if not ruta_original or not destino or not os.path.isfile(ruta_original):
+        return
+    
+    extension = os.path.splitext(original)[1].lstrip('.').lower()
+    formato = next((f for f, e in EXTENSIONES.items() if e == extension), None)
+    if not formato:
+        return
+    try:
+        with open(ruta_original, 'rb') as archivo:
+            # Solo se limita el ancho, como c_limit en Cloudinary
+            imagen = procesar_imagen(archivo, (ancho, ancho * 10), formato=formato, calidad=IMAGEN_CALIDAD)
+    except ImagenInvalida as e:
+        print(f"⚠️ No se pudo generar la variante {ruta}: {str(e)}")
+        return
+    if imagen.extension == extension:
+        almacenamiento.escribir(destino, imagen.datos)
+        # Si el original se eliminó mientras tanto, la variante quedaría huérfana
+        if not os.path.isfile(ruta_original):
+            try:
+                os.remove(destino)
+            except OSError:
+                pass
+
+@app.route('/medios/<path:ruta>')
+def servir_medio(ruta):
+    """Imágenes del almacenamiento local; el nombre lleva un hash del contenido,
+    así que pueden guardarse en caché indefinidamente"""
+    if not isinstance(almacenamiento, AlmacenamientoLocal):
+        abort(404)
+    ruta_archivo = safe_join(almacenamiento.directorio, ruta)
+    if ruta_archivo and not os.path.isfile(ruta_archivo):
+        generar_variante_local(ruta)
+    respuesta = send_from_directory(almacenamiento.directorio, ruta, max_age=MEDIOS_CACHE_MAX_AGE)
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    return respuesta
 
 @app.route('/terms')
 def terms():
     """Página de términos y condiciones"""
     return render_template('terms.html')
 
+# ===== RUTAS DEL PANEL DE ADMINISTRACIÓN =====
+
 @app.route('/admin')
 @login_required
 def panel_admin():
-    """Panel de administración"""
-    productos = Producto.query.all()
-    pedidos = Pedido.query.order_by(Pedido.fecha_pedido.desc()).all()
-    usuarios = Usuario.query.all()
-    categorias = Categoria.query.all()
-    
-    # Debug: imprimir categorías
-    print(f"DEBUG ADMIN: Categorías encontradas: {len(categorias)}")
-    for cat in categorias:
-        print(f"  - {cat.nombre} (ID: {cat.id}, Activa: {cat.activa})")
-    
-    # Estadísticas para la configuración
-    productos_activos = Producto.query.filter_by(activo=True).count()
-    total_pedidos = Pedido.query.count()
-    total_usuarios = Usuario.query.count()
-    total_categorias = Categoria.query.filter_by(activa=True).count()
-    
-    return render_template('admin.html', 
-                         productos=productos, 
-                         pedidos=pedidos,
-                         categorias=categorias,
-                         productos_activos=productos_activos,
-                         total_pedidos=total_pedidos,
-                         total_usuarios=total_usuarios,
-                         total_categorias=total_categorias)
+    """Panel de administración (los listados se cargan bajo demanda desde la API)"""
+    # Solo id y nombre para el selector de categoría del formulario de productos
+    categorias = db.session.query(Categoria.id, Categoria.nombre).order_by(Categoria.id).all()
+    return render_template('admin.html', categorias=categorias)
+
+@app.route('/api/admin/resumen', methods=['GET'])
+@login_required
+def get_resumen_admin():
+    """Obtiene los contadores del panel de administración"""
+    try:
+        return jsonify({
+            'success': True,
+            'productos_activos': Producto.query.filter_by(activo=True).count(),
+            'total_pedidos': sum(ContadorPedido.obtener().values()),
+            'total_usuarios': Usuario.query.count(),
+            'total_categorias': Categoria.query.filter_by(activa=True).count()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/admin/productos', methods=['GET'])
+@login_required
+def get_productos_admin():
+    """Obtiene una página de productos (activos e inactivos) para el panel"""
+    try:
+        pagina, por_pagina = obtener_paginacion()
+        consulta = Producto.query.options(joinedload(Producto.categoria)).order_by(Producto.id)
+        productos, hay_mas = paginar(consulta, pagina, por_pagina)
+        return jsonify({
+            'success': True,
+            'productos': [producto.to_dict() for producto in productos],
+            'pagina': pagina,
+            'por_pagina': por_pagina,
+            'hay_mas': hay_mas
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/admin/categorias', methods=['GET'])
+@login_required
+def get_categorias_admin():
+    """Obtiene una página de categorías (activas e inactivas) con su conteo de productos"""
+    try:
+        pagina, por_pagina = obtener_paginacion()
+        filas = Categoria.with_counts(limite=por_pagina + 1, desplazamiento=(pagina - 1) * por_pagina)
+        return jsonify({
+            'success': True,
+            'categorias': [
+                categoria.to_dict(total_productos=activos + inactivos)
+                for categoria, activos, inactivos in filas[:por_pagina]
+            ],
+            'pagina': pagina,
+            'por_pagina': por_pagina,
+            'hay_mas': len(filas) > por_pagina
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
 
 @app.route('/login', methods=['GET', 'POST'])
 def login_usuario():
@@ -2034,6 +4157,10 @@ def logout_usuario():
 with app.app_context():
     db.create_all()
     
+    # create_all no modifica tablas ya existentes: los cambios van como migraciones
+    if MIGRAR_AL_INICIAR:
+        aplicar_migraciones(db.engine)
+    
     # Crear usuario administrador por defecto si no existe
     if Usuario.query.count() == 0:
         admin = Usuario(
@@ -2087,6 +4214,70 @@ with app.app_context():
         db.session.commit()
         print("✅ Productos de ejemplo creados")
 
+@app.cli.command('despachar-whatsapp')
+def despachar_whatsapp_comando():
+    """Procesa el outbox de WhatsApp como proceso independiente"""
+    print("📨 Despachador de WhatsApp iniciado")
+    while True:
+        if not procesar_outbox_whatsapp():
+            time.sleep(WHATSAPP_INTERVALO_DESPACHO)
+
+@app.cli.command('reconciliar-contadores')
+def reconciliar_contadores_comando():
+    """Reconstruye los contadores de pedidos por estado desde la tabla de pedidos"""
+    anteriores = ContadorPedido.obtener()
+    nuevos = ContadorPedido.reconciliar()
+    for estado in sorted(set(anteriores) | set(nuevos)):
+        antes, despues = anteriores.get(estado, 0), nuevos.get(estado, 0)
+        marca = '' if antes == despues else f'  (antes {antes})'
+        print(f"{estado}: {despues}{marca}")
+    print("✅ Contadores de pedidos reconciliados")
+
+@app.cli.command('eliminar-imagenes')
+def eliminar_imagenes_comando():
+    """Procesa la cola de eliminación de imágenes como proceso independiente"""
+    print("🗑️ Eliminación de imágenes en segundo plano iniciada")
+    while True:
+        if not procesar_eliminaciones_imagenes():
+            time.sleep(IMAGENES_ELIMINACION_INTERVALO)
+
+@app.cli.command('barrer-imagenes')
+@click.option('--aplicar', is_flag=True, help='Encolar la eliminación (por defecto solo se listan)')
+@click.option('--gracia-horas', type=float, default=IMAGENES_HUERFANAS_GRACIA_HORAS,
+              help='Ignorar imágenes subidas hace menos de estas horas')
+def barrer_imagenes_comando(aplicar, gracia_horas):
+    """Lista (o encola para eliminar) las imágenes que nada referencia"""
+    huerfanas = barrer_imagenes_huerfanas(aplicar=aplicar, gracia_horas=gracia_horas)
+    for url in huerfanas:
+        print(url)
+    if aplicar:
+        print(f"✅ {len(huerfanas)} imágenes huérfanas encoladas para eliminar")
+    else:
+        print(f"ℹ️ {len(huerfanas)} imágenes huérfanas (use --aplicar para eliminarlas)")
+
+@app.cli.command('limpiar-trabajos')
+@click.option('--horas', type=float, default=TRABAJOS_RETENCION_HORAS,
+              help='Eliminar los archivos de trabajos con más de estas horas')
+def limpiar_trabajos_comando(horas):
+    """Elimina los archivos de exportación vencidos y los restos de trabajos"""
+    eliminados = limpiar_archivos_trabajos(horas)
+    print(f"✅ {eliminados} archivos de trabajos eliminados")
+
+# Despachador de WhatsApp en segundo plano (desactivar con WHATSAPP_DESPACHADOR_HILO=false
+# cuando se ejecute como proceso separado con `flask --app app despachar-whatsapp`)
+if WHATSAPP_DESPACHADOR_HILO:
+    despachador_whatsapp.iniciar()
+
+# Lo mismo para la cola de eliminación de imágenes (`flask --app app eliminar-imagenes`)
+if IMAGENES_DESPACHADOR_HILO:
+    despachador_imagenes.iniciar()
+    if IMAGENES_BARRIDO_HORAS > 0:
+        barrido_imagenes.iniciar()
+
+# Limpieza de archivos de exportación vencidos (o `flask --app app limpiar-trabajos` desde cron)
+if TRABAJOS_LIMPIEZA_HILO:
+    limpieza_trabajos.iniciar()
+
 if __name__ == '__main__':
     print("🚀 Iniciando servidor...")
     print("📱 Asegúrate de configurar las variables de entorno para WhatsApp")
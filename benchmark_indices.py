@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Benchmark de los índices de migraciones.py
+
+Crea una base de datos de prueba con datos sintéticos y, para cada consulta
+frecuente de la aplicación, muestra el plan de ejecución y el tiempo medio
+antes y después de aplicar las migraciones.
+
+Uso:
+    python benchmark_indices.py                       # SQLite temporal
+    python benchmark_indices.py --url postgresql://...  # base de datos VACÍA de pruebas
+    python benchmark_indices.py --productos 20000 --pedidos 200000
+
+Nunca apuntar --url a la base de datos de producción: el script crea y borra tablas.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Float, ForeignKey, Integer, MetaData, String, Table, Text,
+    create_engine, insert, text
+)
+
+from migraciones import aplicar_migraciones
+
+# Esquema mínimo de las tablas involucradas, sin índices secundarios
+metadata = MetaData()
+
+categoria = Table(
+    'categoria', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('nombre', String(50), nullable=False),
+)
+producto = Table(
+    'producto', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('nombre', String(100), nullable=False),
+    Column('descripcion', Text),
+    Column('precio', Float, nullable=False),
+    Column('stock', Integer),
+    Column('activo', Boolean),
+    Column('categoria_id', Integer, ForeignKey('categoria.id')),
+)
+pedido = Table(
+    'pedido', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('cliente_nombre', String(100), nullable=False),
+    Column('cliente_telefono', String(20), nullable=False),
+    Column('total', Float, nullable=False),
+    Column('estado', String(20)),
+    Column('fecha_pedido', DateTime),
+)
+pedido_item = Table(
+    'pedido_item', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('pedido_id', Integer, ForeignKey('pedido.id'), nullable=False),
+    Column('producto_id', Integer, ForeignKey('producto.id'), nullable=False),
+    Column('cantidad', Integer, nullable=False),
+    Column('precio_unitario', Float, nullable=False),
+)
+contador_pedido = Table(
+    'contador_pedido', metadata,
+    Column('estado', String(20), primary_key=True),
+    Column('total', Integer, nullable=False),
+)
+banner = Table(
+    'banner', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('nombre', String(100), nullable=False),
+    Column('imagen_url', String(500), nullable=False),
+    Column('activo', Boolean),
+    Column('orden', Integer),
+)
+
+# (nombre, SQL, parámetros) de las consultas frecuentes de app.py
+CONSULTAS = [
+    ('Catálogo por id (tienda, /api/productos)',
+     'SELECT id, nombre, precio FROM producto WHERE activo = :activo AND id > :cursor ORDER BY id LIMIT 25',
+     {'activo': True, 'cursor': 1000}),
+    ('Catálogo filtrado por categoría',
+     'SELECT id, nombre, precio FROM producto WHERE activo = :activo AND categoria_id = :categoria ORDER BY id LIMIT 25',
+     {'activo': True, 'categoria': 3}),
+    ('Importador: productos por nombre',
+     'SELECT id, nombre FROM producto WHERE nombre IN (:n1, :n2, :n3)',
+     {'n1': 'Producto 10', 'n2': 'Producto 500', 'n3': 'Producto 999'}),
+    ('Notificaciones: pedidos pendientes',
+     'SELECT count(*) FROM pedido WHERE estado = :estado',
+     {'estado': 'pendiente'}),
+    ('Pedidos recientes (/api/pedidos)',
+     'SELECT * FROM pedido ORDER BY fecha_pedido DESC, id DESC LIMIT 25',
+     {}),
+    ('Pedidos por estado (/api/pedidos?estado=)',
+     'SELECT * FROM pedido WHERE estado = :estado ORDER BY fecha_pedido DESC, id DESC LIMIT 25',
+     {'estado': 'confirmado'}),
+    ('Pedidos de un cliente (/api/pedidos?telefono=)',
+     'SELECT * FROM pedido WHERE cliente_telefono = :telefono ORDER BY fecha_pedido DESC, id DESC LIMIT 25',
+     {'telefono': '900000123'}),
+    ('Items de una página de pedidos',
+     'SELECT * FROM pedido_item WHERE pedido_id IN (:p1, :p2, :p3)',
+     {'p1': 10, 'p2': 5000, 'p3': 9000}),
+    ('Ventas de un producto',
+     'SELECT count(*) FROM pedido_item WHERE producto_id = :producto',
+     {'producto': 42}),
+    ('Banners activos',
+     'SELECT * FROM banner WHERE activo = :activo ORDER BY orden',
+     {'activo': True}),
+]
+
+
+def poblar(engine, total_productos, total_pedidos):
+    """Inserta datos sintéticos en lotes"""
+    random.seed(1)
+    lote = 5000
+    inicio = datetime(2024, 1, 1)
+    with engine.begin() as conexion:
+        conexion.execute(insert(categoria), [{'id': i, 'nombre': f'Categoría {i}'} for i in range(1, 21)])
+        conexion.execute(insert(banner), [
+            {'id': i, 'nombre': f'Banner {i}', 'imagen_url': 'https://example.com/b.jpg',
+             'activo': i % 3 != 0, 'orden': i}
+            for i in range(1, 51)
+        ])
+        for desde in range(1, total_productos + 1, lote):
+            conexion.execute(insert(producto), [
+                {'id': i, 'nombre': f'Producto {i}', 'descripcion': 'Descripción de prueba',
+                 'precio': round(random.uniform(1, 100), 2), 'stock': random.randint(0, 50),
+                 'activo': random.random() < 0.8, 'categoria_id': random.randint(1, 20)}
+                for i in range(desde, min(desde + lote, total_productos + 1))
+            ])
+        item_id = 1
+        for desde in range(1, total_pedidos + 1, lote):
+            pedidos, items = [], []
+            for i in range(desde, min(desde + lote, total_pedidos + 1)):
+                pedidos.append({
+                    'id': i, 'cliente_nombre': f'Cliente {i}',
+                    'cliente_telefono': f'9{random.randint(0, 9999):08d}',
+                    'total': 0, 'estado': random.choices(['pendiente', 'confirmado', 'entregado'], [1, 2, 17])[0],
+                    'fecha_pedido': inicio + timedelta(minutes=i * 5),
+                })
+                for _ in range(random.randint(1, 4)):
+                    items.append({'id': item_id, 'pedido_id': i, 'producto_id': random.randint(1, total_productos),
+                                  'cantidad': random.randint(1, 3), 'precio_unitario': 10})
+                    item_id += 1
+            conexion.execute(insert(pedido), pedidos)
+            conexion.execute(insert(pedido_item), items)
+
+
+def plan(conexion, sql, parametros):
+    if conexion.dialect.name == 'postgresql':
+        filas = conexion.execute(text('EXPLAIN ' + sql), parametros).all()
+        return [fila[0] for fila in filas]
+    filas = conexion.execute(text('EXPLAIN QUERY PLAN ' + sql), parametros).all()
+    return [fila[-1] for fila in filas]
+
+
+def cronometrar(conexion, sql, parametros, repeticiones):
+    consulta = text(sql)
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        conexion.execute(consulta, parametros).all()
+    return (time.perf_counter() - inicio) / repeticiones * 1000
+
+
+def medir(engine, repeticiones):
+    with engine.connect() as conexion:
+        conexion.execute(text('ANALYZE'))
+        return [
+            (plan(conexion, sql, parametros), cronometrar(conexion, sql, parametros, repeticiones))
+            for _, sql, parametros in CONSULTAS
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Planes de consulta antes y después de las migraciones')
+    parser.add_argument('--url', help='URL de una base de datos vacía de pruebas (por defecto SQLite temporal)')
+    parser.add_argument('--productos', type=int, default=10000)
+    parser.add_argument('--pedidos', type=int, default=100000)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    args = parser.parse_args()
+
+    ruta_temporal = None
+    if args.url:
+        url = args.url
+    else:
+        descriptor, ruta_temporal = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        url = f'sqlite:///{ruta_temporal}'
+
+    engine = create_engine(url)
+    try:
+        metadata.drop_all(engine)
+        with engine.begin() as conexion:
+            conexion.execute(text('DROP TABLE IF EXISTS migracion_esquema'))
+        metadata.create_all(engine)
+        print(f'Poblando {args.productos} productos y {args.pedidos} pedidos...')
+        poblar(engine, args.productos, args.pedidos)
+
+        antes = medir(engine, args.repeticiones)
+        aplicar_migraciones(engine, mostrar=lambda *_: None)
+        despues = medir(engine, args.repeticiones)
+
+        for (nombre, sql, _), (plan_antes, ms_antes), (plan_despues, ms_despues) in zip(CONSULTAS, antes, despues):
+            print(f'\n=== {nombre} ===')
+            print(f'{sql}')
+            print(f'  Antes   ({ms_antes:8.3f} ms):')
+            for linea in plan_antes:
+                print(f'      {linea}')
+            print(f'  Después ({ms_despues:8.3f} ms):')
+            for linea in plan_despues:
+                print(f'      {linea}')
+    finally:
+        metadata.drop_all(engine)
+        with engine.begin() as conexion:
+            conexion.execute(text('DROP TABLE IF EXISTS migracion_esquema'))
+        engine.dispose()
+        if ruta_temporal:
+            os.remove(ruta_temporal)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Procesamiento local de imágenes antes de subirlas.
+
+Las fotos llegan tal cual salen del teléfono (varios MB, con EXIF). Aquí se
+valida el archivo leyendo su cabecera, se aplica la orientación EXIF, se reduce
+a la caja de destino, se descartan los metadatos y se recodifica en WebP o JPEG,
+de modo que lo que se sube pesa una fracción del original.
+"""
+
+import io
+from collections import namedtuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+# Cajas máximas (ancho, alto) por tipo de imagen
+TAMANO_PRODUCTO = (800, 600)
+TAMANO_LOGO = (300, 300)
+TAMANO_BANNER = (1200, 300)
+
+# Formatos de entrada aceptados, según lo que Pillow detecta en la cabecera
+FORMATOS_PERMITIDOS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+# Límite de píxeles de la imagen original (protege de "bombas de descompresión")
+MAX_PIXELES = 50_000_000
+
+EXTENSIONES = {'WEBP': 'webp', 'JPEG': 'jpg'}
+TIPOS_MIME = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+ImagenProcesada = namedtuple('ImagenProcesada', 'datos formato extension tipo_mime ancho alto')
+
+
+class ImagenInvalida(ValueError):
+    """El archivo no es una imagen aceptada"""
+
+
+def formato_salida(preferido='WEBP'):
+    """Devuelve el formato de salida soportado por esta instalación de Pillow"""
+    preferido = (preferido or 'WEBP').upper()
+    if preferido == 'WEBP' and not features.check('webp'):
+        return 'JPEG'
+    return preferido if preferido in EXTENSIONES else 'WEBP'
+
+
+def procesar_imagen(archivo, caja, formato='WEBP', calidad=82):
+    """Valida, orienta, reduce y recodifica una imagen.
+
+    `archivo` es cualquier objeto con read() (por ejemplo un FileStorage de Flask).
+    La imagen solo se reduce, nunca se amplía; las animaciones conservan el primer
+    cuadro. Lanza ImagenInvalida si el archivo no es una imagen aceptada.
+    """
+    formato = formato_salida(formato)
+    try:
+        # Image.open solo lee la cabecera: el formato y el tamaño se validan
+        # antes de decodificar los píxeles
+        imagen = Image.open(archivo)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        raise ImagenInvalida('El archivo no es una imagen válida')
+
+    if imagen.format not in FORMATOS_PERMITIDOS:
+        raise ImagenInvalida('Formato de imagen no permitido. Use PNG, JPG, JPEG, GIF o WEBP')
+    ancho, alto = imagen.size
+    if ancho * alto > MAX_PIXELES:
+        raise ImagenInvalida('La imagen es demasiado grande')
+
+    try:
+        # En JPEG el decodificador puede reducir al leer (escala DCT); se pide el
+        # lado mayor de la caja en ambos ejes porque la orientación EXIF puede rotarla
+        if imagen.format == 'JPEG':
+            lado = max(caja)
+            imagen.draft('RGB', (lado, lado))
+        imagen = ImageOps.exif_transpose(imagen)
+        imagen.thumbnail(caja, Image.LANCZOS)
+
+        transparente = imagen.mode in ('RGBA', 'LA') or (imagen.mode == 'P' and 'transparency' in imagen.info)
+        if formato == 'WEBP' and transparente:
+            imagen = imagen.convert('RGBA')
+        elif transparente:
+            # JPEG no admite transparencia: se compone sobre fondo blanco
+            fondo = Image.new('RGB', imagen.size, (255, 255, 255))
+            fondo.paste(imagen.convert('RGBA'), mask=imagen.convert('RGBA').getchannel('A'))
+            imagen = fondo
+        elif imagen.mode != 'RGB':
+            imagen = imagen.convert('RGB')
+
+        salida = io.BytesIO()
+        # Sin exif= ni icc_profile= el archivo nuevo no lleva metadatos
+        if formato == 'WEBP':
+            imagen.save(salida, 'WEBP', quality=calidad, method=4)
+        else:
+            imagen.save(salida, 'JPEG', quality=calidad, optimize=True, progressive=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ImagenInvalida('No se pudo procesar la imagen')
+
+    return ImagenProcesada(
+        datos=salida.getvalue(),
+        formato=formato,
+        extension=EXTENSIONES[formato],
+        tipo_mime=TIPOS_MIME[formato],
+        ancho=imagen.width,
+        alto=imagen.height
+    )
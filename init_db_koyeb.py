@@ -9,6 +9,7 @@ import sys
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from migraciones import aplicar_migraciones
 
 # Configurar Flask para la inicialización
 app = Flask(__name__)
@@ -42,6 +43,10 @@ with app.app_context():
             db.create_all()
             print("Tablas creadas exitosamente")
             
+            print("Aplicando migraciones...")
+            aplicar_migraciones(db.engine)
+            print("Migraciones aplicadas exitosamente")
+            
             # Verificar si ya existen categorías
             if Categoria.query.count() == 0:
                 print("Creando categorías por defecto...")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Migraciones versionadas del esquema de la base de datos.
+
+db.create_all() crea las tablas nuevas pero no modifica las existentes, así que
+los cambios sobre tablas ya creadas (índices, cargas de datos) se registran aquí
+como migraciones numeradas. Cada versión aplicada se guarda en la tabla
+`migracion_esquema` y no se vuelve a ejecutar.
+
+En PostgreSQL los índices se crean con CREATE INDEX CONCURRENTLY para no
+bloquear escrituras en tablas grandes (pedido, pedido_item).
+
+Uso:
+    python migraciones.py            # aplica las migraciones pendientes
+    python migraciones.py --estado   # lista migraciones aplicadas y pendientes
+"""
+
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import text
+
+# Clave del pg_advisory_lock que serializa aplicar_migraciones entre procesos
+CLAVE_BLOQUEO_MIGRACIONES = 728491
+
+
+def busqueda_postgresql_activa():
+    """La búsqueda de texto completo solo se instala si se eligió ese backend"""
+    return os.environ.get('BUSQUEDA_BACKEND', 'memoria') == 'postgresql'
+
+
+class CrearIndice:
+    """Operación de migración: crear un índice si no existe.
+
+    `columnas` puede incluir expresiones; `metodo` (p. ej. 'gin') y `dialecto`
+    restringen el índice a un motor concreto. Ver `condicion` en EjecutarSQL.
+    """
+
+    # CREATE INDEX CONCURRENTLY no puede ejecutarse dentro de una transacción
+    transaccional = False
+
+    def __init__(self, nombre, tabla, columnas, metodo=None, dialecto=None, condicion=None):
+        self.nombre = nombre
+        self.tabla = tabla
+        self.columnas = columnas
+        self.metodo = metodo
+        self.dialecto = dialecto
+        self.condicion = condicion
+
+    def aplicar(self, conexion):
+        columnas = ', '.join(self.columnas)
+        metodo = f'USING {self.metodo} ' if self.metodo else ''
+        if conexion.dialect.name == 'postgresql':
+            # Un CREATE INDEX CONCURRENTLY interrumpido deja un índice inválido
+            # que IF NOT EXISTS no recrearía: se elimina antes de reintentar
+            invalido = conexion.execute(text(
+                "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE c.relname = :nombre AND NOT i.indisvalid"
+            ), {'nombre': self.nombre}).first()
+            if invalido:
+                conexion.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {self.nombre}'))
+            conexion.execute(text(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.nombre} ON {self.tabla} {metodo}({columnas})'
+            ))
+        else:
+            conexion.execute(text(
+                f'CREATE INDEX IF NOT EXISTS {self.nombre} ON {self.tabla} {metodo}({columnas})'
+            ))
+
+    def __str__(self):
+        return f'índice {self.nombre} en {self.tabla} ({", ".join(self.columnas)})'
+
+
+class EjecutarSQL:
+    """Operación de migración: ejecutar sentencias SQL en orden (solo en `dialecto` si se indica).
+
+    Las sentencias se ejecutan en una sola transacción: nadie ve el estado intermedio
+    (por ejemplo, la tabla vacía entre un DELETE y la recarga). Si `condicion` (una
+    función) devuelve False, la migración completa queda pendiente sin registrarse.
+    """
+
+    transaccional = True
+
+    def __init__(self, descripcion, *sentencias, dialecto=None, condicion=None):
+        self.descripcion = descripcion
+        self.sentencias = sentencias
+        self.dialecto = dialecto
+        self.condicion = condicion
+
+    def aplicar(self, conexion):
+        for sentencia in self.sentencias:
+            conexion.execute(text(sentencia))
+
+    def __str__(self):
+        return self.descripcion
+
+
+# Lista ordenada de migraciones: (versión, descripción, operaciones).
+# Las migraciones ya publicadas no se modifican; los cambios van en una nueva versión.
+MIGRACIONES = [
+    ('0001', 'Índices para las consultas frecuentes', [
+        CrearIndice('ix_producto_activo_id', 'producto', ['activo', 'id']),
+        CrearIndice('ix_producto_categoria_id', 'producto', ['categoria_id']),
+        CrearIndice('ix_producto_nombre', 'producto', ['nombre']),
+        CrearIndice('ix_pedido_fecha_id', 'pedido', ['fecha_pedido', 'id']),
+        CrearIndice('ix_pedido_estado_fecha_id', 'pedido', ['estado', 'fecha_pedido', 'id']),
+        CrearIndice('ix_pedido_telefono_fecha_id', 'pedido', ['cliente_telefono', 'fecha_pedido', 'id']),
+        CrearIndice('ix_pedido_item_pedido_id', 'pedido_item', ['pedido_id']),
+        CrearIndice('ix_pedido_item_producto_id', 'pedido_item', ['producto_id']),
+        CrearIndice('ix_banner_activo_orden', 'banner', ['activo', 'orden']),
+    ]),
+    ('0002', 'Contadores de pedidos por estado', [
+        # La tabla la crea db.create_all(); aquí solo se carga desde los pedidos existentes
+        EjecutarSQL(
+            'carga inicial de contador_pedido',
+            'DELETE FROM contador_pedido',
+            "INSERT INTO contador_pedido (estado, total) "
+            "SELECT COALESCE(estado, 'pendiente'), COUNT(*) FROM pedido GROUP BY COALESCE(estado, 'pendiente')",
+        ),
+    ]),
+    ('0003', 'Búsqueda de texto completo (PostgreSQL)', [
+        # Solo con BUSQUEDA_BACKEND=postgresql: CREATE EXTENSION requiere privilegios
+        # que el rol de la aplicación puede no tener
+        # unaccent no es IMMUTABLE y no puede usarse en un índice: se envuelve en f_unaccent
+        EjecutarSQL(
+            'extensión unaccent y función f_unaccent',
+            'CREATE EXTENSION IF NOT EXISTS unaccent',
+            "CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS "
+            "$$ SELECT public.unaccent('public.unaccent', $1) $$ "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+            dialecto='postgresql',
+            condicion=busqueda_postgresql_activa,
+        ),
+        # Misma expresión que BusquedaPostgreSQL.DOCUMENTO_PRODUCTO en app.py
+        CrearIndice('ix_producto_busqueda', 'producto', [
+            "(setweight(to_tsvector('spanish', f_unaccent(coalesce(nombre, ''))), 'A') || "
+            "setweight(to_tsvector('spanish', f_unaccent(coalesce(descripcion, ''))), 'C'))"
+        ], metodo='gin', dialecto='postgresql', condicion=busqueda_postgresql_activa),
+    ]),
+]
+
+
+def crear_tabla_versiones(engine):
+    with engine.begin() as conexion:
+        conexion.execute(text(
+            'CREATE TABLE IF NOT EXISTS migracion_esquema ('
+            'version VARCHAR(20) PRIMARY KEY, '
+            'descripcion VARCHAR(200), '
+            'fecha_aplicacion TIMESTAMP NOT NULL)'
+        ))
+
+
+def versiones_aplicadas(engine):
+    """Devuelve el conjunto de versiones ya aplicadas"""
+    crear_tabla_versiones(engine)
+    with engine.connect() as conexion:
+        return {fila[0] for fila in conexion.execute(text('SELECT version FROM migracion_esquema'))}
+
+
+def aplicar_migraciones(engine, mostrar=print):
+    """Aplica en orden las migraciones pendientes y devuelve las versiones aplicadas.
+
+    Las operaciones son idempotentes (IF NOT EXISTS, borrar y recargar), así que si
+    el proceso se interrumpe a mitad de una migración basta con volver a ejecutarlo.
+    En PostgreSQL un advisory lock evita que dos procesos apliquen la misma
+    migración a la vez: el segundo espera y luego encuentra la versión registrada.
+    """
+    crear_tabla_versiones(engine)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as bloqueo:
+        postgresql = bloqueo.dialect.name == 'postgresql'
+        if postgresql:
+            bloqueo.execute(text('SELECT pg_advisory_lock(:clave)'), {'clave': CLAVE_BLOQUEO_MIGRACIONES})
+        try:
+            return _aplicar_pendientes(engine, mostrar)
+        finally:
+            if postgresql:
+                bloqueo.execute(text('SELECT pg_advisory_unlock(:clave)'), {'clave': CLAVE_BLOQUEO_MIGRACIONES})
+
+
+def _aplicar_pendientes(engine, mostrar):
+    aplicadas = versiones_aplicadas(engine)
+    nuevas = []
+    for version, descripcion, operaciones in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        operaciones = [op for op in operaciones if op.dialecto in (None, engine.dialect.name)]
+        # Sin registrar: se aplicará cuando se cumpla la condición (p. ej. al cambiar de backend)
+        if any(op.condicion and not op.condicion() for op in operaciones):
+            mostrar(f'Omitiendo migración {version}: {descripcion} (no aplica con la configuración actual)')
+            continue
+        mostrar(f'Aplicando migración {version}: {descripcion}')
+        for operacion in operaciones:
+            mostrar(f'  - {operacion}')
+            if operacion.transaccional:
+                with engine.begin() as conexion:
+                    operacion.aplicar(conexion)
+            else:
+                with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexion:
+                    operacion.aplicar(conexion)
+        with engine.begin() as conexion:
+            # Otro proceso pudo registrar la misma versión mientras tanto
+            ya_registrada = conexion.execute(
+                text('SELECT 1 FROM migracion_esquema WHERE version = :version'), {'version': version}
+            ).first()
+            if not ya_registrada:
+                conexion.execute(text(
+                    'INSERT INTO migracion_esquema (version, descripcion, fecha_aplicacion) '
+                    'VALUES (:version, :descripcion, :fecha)'
+                ), {'version': version, 'descripcion': descripcion, 'fecha': datetime.utcnow()})
+        nuevas.append(version)
+    return nuevas
+
+
+if __name__ == '__main__':
+    from app import app, db
+
+    with app.app_context():
+        if '--estado' in sys.argv:
+            aplicadas = versiones_aplicadas(db.engine)
+            for version, descripcion, _ in MIGRACIONES:
+                marca = 'aplicada ' if version in aplicadas else 'pendiente'
+                print(f'{version} [{marca}] {descripcion}')
+        else:
+            nuevas = aplicar_migraciones(db.engine)
+            print(f'✅ {len(nuevas)} migraciones aplicadas' if nuevas else '✅ El esquema está al día')